@@ -1,66 +1,131 @@
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
-from flask import Flask, request
+from flask import Flask, current_app, request
 from flask_babel import Babel, lazy_gettext as _l
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_migrate import Migrate
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 import os
 
+from app.replicas import RoutingSession
+from app.sqlite import apply_pragmas
 from config import Config
 
 
 def get_locale():
-    return request.accept_languages.best_match(app.config["LANGUAGES"])
+    return request.accept_languages.best_match(current_app.config["LANGUAGES"])
 
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login = LoginManager(app)
-login.login_view = "login"
+# Extensions are created unbound, create_app() attaches them to each application.
+# Flask-Migrate is not one of them, it imports all of alembic, see cli.MigrateGroup
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+login = LoginManager()
+login.login_view = "auth.login"
 login.login_message = _l("Please log in to access this page.")
+mail = Mail()
+moment = Moment()
+babel = Babel()
 
 
-if not app.debug:
-    if app.config["MAIL_SERVER"]:
-        auth = None
-        if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
-            auth = (app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
-        secure = None
-        if app.config["MAIL_USE_TLS"]:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
-            fromaddr="no-reply@" + app.config["MAIL_SERVER"],
-            toaddrs=app.config["ADMINS"],
-            subject="Microblog Failure",
-            credentials=auth,
-            secure=secure,
-        )
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-        if not os.path.exists("logs"):
-            os.mkdir("logs")
-        file_handler = RotatingFileHandler(
-            "logs/microblog.log", maxBytes=10240, backupCount=10
-        )
-        file_handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
+def create_app(config_class=Config):
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            apply_pragmas(engine, app.config["SQLITE_PRAGMAS"])
+    login.init_app(app)
+    mail.init_app(app)
+    moment.init_app(app)
+    babel.init_app(app, locale_selector=get_locale)
+
+    # Metrics first, so its before_request hook times everything the others do
+    from app import metrics
+
+    metrics.init_app(app)
+
+    # Each worker's caches, pools and queues live on the app, so every app gets its own
+    from app import (
+        email,
+        fragments,
+        graph,
+        language,
+        last_seen,
+        models,
+        passwords,
+        recent,
+        stream,
+        translate,
+    )
+
+    for module in (
+        email,
+        fragments,
+        graph,
+        language,
+        last_seen,
+        models,
+        passwords,
+        recent,
+        stream,
+        translate,
+    ):
+        module.init_app(app)
+
+    from app.errors import bp as errors_bp
+
+    app.register_blueprint(errors_bp)
+
+    from app.auth import bp as auth_bp
+
+    app.register_blueprint(auth_bp)
+
+    from app.routes import bp as main_bp
+
+    app.register_blueprint(main_bp)
+
+    from app.cli import bp as cli_bp
+
+    app.register_blueprint(cli_bp)
+
+    if not app.debug and not app.testing:
+        if app.config["MAIL_SERVER"]:
+            auth = None
+            if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
+                auth = (app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
+            secure = None
+            if app.config["MAIL_USE_TLS"]:
+                secure = ()
+            mail_handler = SMTPHandler(
+                mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
+                fromaddr="no-reply@" + app.config["MAIL_SERVER"],
+                toaddrs=app.config["ADMINS"],
+                subject="Microblog Failure",
+                credentials=auth,
+                secure=secure,
             )
-        )
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+            mail_handler.setLevel(logging.ERROR)
+            app.logger.addHandler(mail_handler)
+
+            if not os.path.exists("logs"):
+                os.mkdir("logs")
+            file_handler = RotatingFileHandler(
+                "logs/microblog.log", maxBytes=10240, backupCount=10
+            )
+            file_handler.setFormatter(
+                logging.Formatter(
+                    "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
+                )
+            )
+            file_handler.setLevel(logging.INFO)
+            app.logger.addHandler(file_handler)
+
+            app.logger.setLevel(logging.INFO)
+            app.logger.info("Microblog startup")
+
+    return app
 
-        app.logger.setLevel(logging.INFO)
-        app.logger.info("Microblog startup")
-mail = Mail(app)
-moment = Moment(app)
-babel = Babel(app, locale_selector=get_locale)
 
-from app import cli, routes, models, errors  # noqa
+from app import models  # noqa
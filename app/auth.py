@@ -0,0 +1,100 @@
+from flask import Blueprint, flash, redirect, render_template, request, url_for
+from flask_babel import _
+from flask_login import current_user, login_user, logout_user
+import sqlalchemy as sa
+from urllib.parse import urlsplit
+
+from app import db
+from app import replicas
+from app.email import send_password_reset_email
+from app.forms import (
+    LoginForm,
+    RegistrationForm,
+    ResetPasswordForm,
+    ResetPasswordRequestForm,
+)
+from app.models import User, forget_user
+
+bp = Blueprint("auth", __name__)
+
+
+@bp.route("/login", methods=["GET", "POST"])
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    form = LoginForm()
+    if form.validate_on_submit():
+        user = db.session.scalar(
+            sa.select(User).where(User.username == form.username.data)
+        )
+        if user is None or not user.check_password(form.password.data):
+            flash(_("Invalid username or password"))
+            return redirect(url_for("auth.login"))
+        # Saves the new hash if check_password() upgraded it
+        db.session.commit()
+        login_user(user, remember=form.remember_me.data)
+        # If a non-logged in-user tries to access /index, it'll add the query to url as such: /login?next=/index
+        next_page = request.args.get("next")
+        # netloc gets domain name of url (ex: example.com/path.netloc -> example.com)
+        # this check avoid redirecting to external site which would be an avenue for a phishing attack (open redirect)
+        if not next_page or urlsplit(next_page).netloc != "":
+            next_page = url_for("main.index")
+        return redirect(next_page)
+    return render_template("login.html", title="Sign In", form=form)
+
+
+@bp.route("/logout")
+def logout():
+    logout_user()
+    return redirect(url_for("main.index"))
+
+
+@bp.route("/register", methods=["GET", "POST"])
+def register():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    form = RegistrationForm()
+    # Was the form submitted (is this a post request), and did all the validators pass
+    if form.validate_on_submit():
+        user = User(username=form.username.data, email=form.email.data)
+        user.set_password(form.password.data)
+        db.session.add(user)
+        db.session.commit()
+        flash(_("Good job, you signed up. Whoopie."))
+        return redirect(url_for("auth.login"))
+    return render_template("register.html", title="Register", form=form)
+
+
+@bp.route("/reset_password/<token>", methods=["GET", "POST"])
+# The link is often followed seconds after it was sent, don't let replica lag reject it
+@replicas.use_primary
+def reset_password(token):
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    user = User.verify_reset_password_token(token)
+    if not user:
+        return redirect(url_for("main.index"))
+    form = ResetPasswordForm()
+    if form.validate_on_submit():
+        user.set_password(form.password.data)
+        db.session.commit()
+        forget_user(user.id)
+        flash(_("Your password has been reset."))
+        return redirect(url_for("auth.login"))
+    return render_template("reset_password.html", form=form)
+
+
+@bp.route("/reset_password_request", methods=["GET", "POST"])
+def reset_password_request():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.index"))
+    form = ResetPasswordRequestForm()
+    if form.validate_on_submit():
+        user = db.session.scalar(sa.select(User).where(User.email == form.email.data))
+        if user:
+            send_password_reset_email(user)
+        flash(_("Check your email for the instructions to reset your password"))
+        return redirect(url_for("auth.login"))
+    return render_template(
+        "reset_password_request.html", title="Reset Password", form=form
+    )
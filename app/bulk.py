@@ -0,0 +1,169 @@
+import csv
+import itertools
+import json
+import os
+from datetime import datetime
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post, User, followers, rebuild_timelines, recompute_counters
+
+# In foreign key order, so importing them one after the other always works
+TABLES = {"users": User.__table__, "posts": Post.__table__, "followers": followers}
+CHECKPOINT = ".import-checkpoint.json"
+# How CSV files write NULL, so it can't be confused with an empty string
+CSV_NULL = "\\N"
+
+
+def data_path(directory, name, format):
+    return os.path.join(directory, f"{name}.{format}")
+
+
+def _dump(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_table(name, path, format, chunk_size):
+    # Returns the number of rows written
+    table = TABLES[name]
+    columns = [column.name for column in table.columns]
+    # yield_per fetches the rows a chunk at a time instead of loading the whole table
+    query = (
+        sa.select(table)
+        .order_by(*table.primary_key.columns)
+        .execution_options(yield_per=chunk_size)
+    )
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if format == "csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+        for row in db.session.execute(query):
+            values = [_dump(value) for value in row]
+            if format == "csv":
+                writer.writerow(
+                    [CSV_NULL if value is None else value for value in values]
+                )
+            else:
+                f.write(json.dumps(dict(zip(columns, values))) + "\n")
+            count += 1
+    return count
+
+
+def _read(path, format):
+    # One record at a time, however big the file is
+    with open(path, newline="", encoding="utf-8") as f:
+        if format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _loader(column, format):
+    def load(value):
+        if value is None or (format == "csv" and value == CSV_NULL):
+            return None
+        if value == "" and format == "csv" and not isinstance(column.type, sa.String):
+            # Files exported before NULL had its own marker wrote it as an empty field
+            return None
+        if isinstance(column.type, sa.DateTime):
+            return datetime.fromisoformat(value)
+        if isinstance(column.type, sa.Integer):
+            return int(value)
+        return value
+
+    return load
+
+
+def _without_existing(table, rows):
+    # The rows an interrupted import was working on may have been committed before its checkpoint
+    pk = list(table.primary_key.columns)
+    keys = [tuple(row[column.name] for column in pk) for row in rows]
+    existing = {
+        tuple(key)
+        for key in db.session.execute(sa.select(*pk).where(sa.tuple_(*pk).in_(keys)))
+    }
+    return [row for row, key in zip(rows, keys) if key not in existing]
+
+
+def load_checkpoint(directory):
+    path = os.path.join(directory, CHECKPOINT)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(directory, checkpoint):
+    # Write and rename, so a crash never leaves half a checkpoint behind
+    path = os.path.join(directory, CHECKPOINT)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def import_table(name, directory, format, chunk_size, checkpoint, progress=None):
+    # Returns the number of rows inserted, committing and checkpointing after every chunk
+    table = TABLES[name]
+    loaders = {column.name: _loader(column, format) for column in table.columns}
+    done = checkpoint.get(name, 0)
+    records = itertools.islice(
+        _read(data_path(directory, name, format), format), done, None
+    )
+    # An interrupted run can have committed one more chunk than its checkpoint says, of whatever
+    # size it used, so rows up to the largest chunk size any run used past it may already exist
+    if name in checkpoint:
+        unsure_until = done + checkpoint.get("chunk_size", chunk_size)
+    else:
+        unsure_until = 0
+    # Checkpointed before the first chunk too, so a rerun knows this table was started
+    checkpoint[name] = done
+    checkpoint["chunk_size"] = max(checkpoint.get("chunk_size", 0), chunk_size)
+    save_checkpoint(directory, checkpoint)
+    inserted = 0
+    while True:
+        chunk = [
+            {
+                key: loaders[key](value)
+                for key, value in record.items()
+                if key in loaders
+            }
+            for record in itertools.islice(records, chunk_size)
+        ]
+        if not chunk:
+            break
+        start = done
+        done += len(chunk)
+        if start < unsure_until:
+            chunk = _without_existing(table, chunk)
+        if chunk:
+            # A Core insert with a list of rows is a single executemany, no ORM objects involved
+            db.session.execute(sa.insert(table), chunk)
+        db.session.commit()
+        inserted += len(chunk)
+        checkpoint[name] = done
+        save_checkpoint(directory, checkpoint)
+        if progress:
+            progress(name, done)
+    return inserted
+
+
+def finish_import():
+    # Everything derived from the imported rows is rebuilt in bulk once, not maintained per row
+    recompute_counters()
+    if current_app.config["MATERIALIZED_TIMELINES"]:
+        rebuild_timelines()
+    if db.engine.dialect.name == "postgresql":
+        # Rows came in with their ids, move the sequences past them
+        for table in (User.__table__, Post.__table__):
+            db.session.execute(
+                sa.text(
+                    f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                    f'COALESCE(MAX(id), 1)) FROM "{table.name}"'
+                )
+            )
+    db.session.commit()
@@ -1,10 +1,57 @@
 import click
 import os
+import time
 
-from app import app
+from flask import Blueprint, current_app, g
 
+from app import db
+from app import bulk
+from app import search as search_index
+from app.models import rebuild_timelines, recompute_counters
 
-@app.cli.group()
+# cli_group=None puts the groups at the top level, flask translate rather than flask cli translate
+bp = Blueprint("cli", __name__, cli_group=None)
+
+
+class MigrateGroup(click.Group):
+    # The commands come from Flask-Migrate, which imports all of alembic, so it is only
+    # loaded when a db command runs instead of in every process that creates the app
+    def _commands(self):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as migrate_commands
+
+        if "migrate" not in current_app.extensions:
+            Migrate(current_app._get_current_object(), db)
+        return migrate_commands
+
+    def list_commands(self, ctx):
+        return self._commands().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._commands().get_command(ctx, name)
+
+
+# The same options as Flask-Migrate's own db group, its commands read them from g
+@bp.cli.group("db", cls=MigrateGroup)
+@click.option(
+    "-d",
+    "--directory",
+    default=None,
+    help='Migration script directory (default is "migrations")',
+)
+@click.option(
+    "-x",
+    "--x-arg",
+    multiple=True,
+    help="Additional arguments consumed by custom env.py scripts",
+)
+def migrations(directory, x_arg):
+    """Perform database migrations."""
+    g.directory = directory
+    g.x_arg = x_arg
+
+
+@bp.cli.group()
 def translate():
     """Translation and localization commands."""
     pass
@@ -36,3 +83,104 @@ def compile():
     """Compile all languages."""
     if os.system("pybabel compile -d app/translations"):
         raise RuntimeError("compile command failed")
+
+
+@bp.cli.group()
+def timeline():
+    """Materialized timeline commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Rebuild every user's timeline from posts and followers."""
+    rebuild_timelines()
+    db.session.commit()
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+@counters.command()
+def recompute():
+    """Recompute follower, following and post counters for every user."""
+    drift = recompute_counters()
+    db.session.commit()
+    for username, name, stored, actual in drift:
+        click.echo(f"{username}: {name} was {stored}, should be {actual}")
+    click.echo(f"Fixed {len(drift)} drifted counter(s).")
+
+
+@bp.cli.group()
+def data():
+    """Bulk import and export commands."""
+    pass
+
+
+def _rate(rows, seconds):
+    return (
+        f"{rows} rows in {seconds:.1f}s ({rows / seconds if seconds else 0:.0f} rows/s)"
+    )
+
+
+@data.command()
+@click.argument("directory")
+@click.option("--format", type=click.Choice(["jsonl", "csv"]), default="jsonl")
+@click.option("--chunk-size", default=10000, show_default=True)
+def export(directory, format, chunk_size):
+    """Export users, posts and followers to files in DIRECTORY."""
+    os.makedirs(directory, exist_ok=True)
+    for name in bulk.TABLES:
+        start = time.perf_counter()
+        rows = bulk.export_table(
+            name, bulk.data_path(directory, name, format), format, chunk_size
+        )
+        click.echo(f"{name}: {_rate(rows, time.perf_counter() - start)}")
+
+
+@data.command("import")
+@click.argument("directory")
+@click.option("--format", type=click.Choice(["jsonl", "csv"]), default="jsonl")
+@click.option("--chunk-size", default=10000, show_default=True)
+def import_(directory, format, chunk_size):
+    """Import users, posts and followers exported to DIRECTORY.
+
+    An interrupted import picks up where it stopped when run again."""
+    checkpoint = bulk.load_checkpoint(directory)
+    for name in bulk.TABLES:
+        if name in checkpoint:
+            click.echo(f"{name}: resuming after {checkpoint[name]} rows")
+    for name in bulk.TABLES:
+        start = time.perf_counter()
+
+        def progress(name, rows):
+            click.echo(f"\r{name}: {rows} rows read", nl=False)
+
+        rows = bulk.import_table(
+            name, directory, format, chunk_size, checkpoint, progress
+        )
+        click.echo(f"\r{name}: {_rate(rows, time.perf_counter() - start)}")
+    bulk.finish_import()
+    os.remove(os.path.join(directory, bulk.CHECKPOINT))
+
+
+@bp.cli.group()
+def search():
+    """Full-text search index commands."""
+    pass
+
+
+@search.command("rebuild")
+@click.option("--batch-size", default=10000, show_default=True)
+def rebuild_search(batch_size):
+    """Index every existing post, a batch at a time."""
+    start = time.perf_counter()
+
+    def progress(rows):
+        click.echo(f"\r{rows} posts indexed", nl=False)
+
+    rows = search_index.rebuild_index(batch_size, progress)
+    click.echo(f"\rposts: {_rate(rows, time.perf_counter() - start)}")
@@ -1,14 +1,104 @@
-from flask import render_template
+import queue
+import threading
+import time
+
+from flask import current_app, render_template
 from flask_babel import _
 from flask_mail import Message
-from app import app
+
 from app import mail
-from threading import Thread
+
+_queue_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    "sent": 0,
+    "failed": 0,
+    "dropped": 0,
+    "connections": 0,
+    "send_seconds": 0.0,
+    "max_send_seconds": 0.0,
+}
+
+
+def init_app(app):
+    # Messages waiting to be sent, drained by a fixed pool of worker threads. Created on first
+    # use so each pre-forked worker process starts its own threads
+    app.extensions["mail_queue"] = None
+
+
+def _get_queue():
+    with _queue_lock:
+        messages = current_app.extensions["mail_queue"]
+        if messages is None:
+            messages = queue.Queue(maxsize=current_app.config["MAIL_QUEUE_SIZE"])
+            for _i in range(current_app.config["MAIL_WORKERS"]):
+                threading.Thread(
+                    target=_send_from_queue,
+                    args=(current_app._get_current_object(), messages),
+                    daemon=True,
+                ).start()
+            current_app.extensions["mail_queue"] = messages
+        return messages
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def _send(conn, msg):
+    start = time.perf_counter()
+    conn.send(msg)
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _stats["sent"] += 1
+        _stats["send_seconds"] += elapsed
+        _stats["max_send_seconds"] = max(_stats["max_send_seconds"], elapsed)
+
+
+def _send_from_queue(app, messages):
+    # A message that failed on one connection, to try once more on a fresh one
+    retrying = None
+    while True:
+        msg = retrying or messages.get()
+        with app.app_context():
+            try:
+                # Keep one SMTP connection open for as long as there are messages waiting
+                with mail.connect() as conn:
+                    _count("connections")
+                    while msg is not None:
+                        _send(conn, msg)
+                        messages.task_done()
+                        msg = retrying = None
+                        try:
+                            msg = messages.get(timeout=app.config["MAIL_IDLE_TIMEOUT"])
+                        except queue.Empty:
+                            pass
+            except Exception:
+                if msg is None:
+                    # Everything was sent, only closing the connection failed
+                    app.logger.warning("Failed to close SMTP connection", exc_info=True)
+                elif retrying is None:
+                    app.logger.warning("Failed to send email, retrying", exc_info=True)
+                    retrying = msg
+                else:
+                    messages.task_done()
+                    retrying = None
+                    _count("failed")
+                    app.logger.exception(
+                        "Dropped email %r to %s", msg.subject, ", ".join(msg.recipients)
+                    )
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    messages = current_app.extensions["mail_queue"]
+    result["queued"] = messages.qsize() if messages is not None else 0
+    result["mean_send_seconds"] = (
+        result["send_seconds"] / result["sent"] if result["sent"] else 0.0
+    )
+    return result
 
 
 # https://pypi.org/project/Flask-Mail/
@@ -16,14 +106,27 @@ def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    messages = _get_queue()
+    try:
+        if current_app.config["MAIL_QUEUE_FULL"] == "drop":
+            messages.put_nowait(msg)
+        else:
+            # Backpressure: hold the request up for a while, then give up
+            messages.put(msg, timeout=current_app.config["MAIL_QUEUE_TIMEOUT"])
+    except queue.Full:
+        _count("dropped")
+        current_app.logger.warning(
+            "Email queue is full, dropped message to %s", recipients
+        )
+        return False
+    return True
 
 
 def send_password_reset_email(user):
     token = user.get_reset_password_token()
     send_email(
         _("[Microblog] Reset Your Password"),
-        sender=app.config["ADMINS"][0],
+        sender=current_app.config["ADMINS"][0],
         recipients=[user.email],
         text_body=render_template("email/reset_password.txt", user=user, token=token),
         html_body=render_template("email/reset_password.html", user=user, token=token),
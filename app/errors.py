@@ -1,13 +1,21 @@
-from flask import render_template
-from app import app, db
+from flask import Blueprint, render_template
+from app import db
+from app.passwords import HashingBusy
 
+bp = Blueprint("errors", __name__)
 
-@app.errorhandler(404)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template("404.html"), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template("500.html"), 500
+
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    return render_template("503.html"), 503
@@ -0,0 +1,86 @@
+import hashlib
+from time import time
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post, followers, timeline
+
+
+def make_etag(*parts):
+    """Validator for a timeline page, from the few values the page depends on."""
+    # None means the page must not be cached, callers can pass it on without checking
+    max_age = current_app.config["ETAG_MAX_AGE"]
+    # A flashed message is shown once, and only a full render takes it out of the session
+    if not max_age or request.method not in ("GET", "HEAD") or "_flashes" in session:
+        return None
+    values = [
+        request.full_path,
+        g.locale,
+        # Every page shows who is looking at it, and whether they follow the people on it
+        current_user.id,
+        current_user.username,
+        current_user.follow_version,
+        # Changes nothing in the parts cover (an author's new name, a language detected later)
+        # can't stay hidden behind a 304 for longer than this
+        int(time() // max_age),
+        *parts,
+    ]
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+
+def not_modified(etag):
+    # A 304 for clients that already have this version of the page, otherwise None
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
+
+
+def tag(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+        # Keep a copy, but ask before using it
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _newest(query):
+    # (id, timestamp) of the newest post, one row off the same index the page is read from
+    return tuple(db.session.execute(query.limit(1)).first() or ())
+
+
+def newest_home_post(user):
+    if current_app.config["MATERIALIZED_TIMELINES"]:
+        return _newest(
+            sa.select(timeline.c.post_id, timeline.c.timestamp)
+            .where(timeline.c.user_id == user.id)
+            .order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        )
+    followed = sa.select(followers.c.followed_id).where(
+        followers.c.follower_id == user.id
+    )
+    return _newest(
+        sa.select(Post.id, Post.timestamp)
+        .where(sa.or_(Post.user_id == user.id, Post.user_id.in_(followed)))
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+    )
+
+
+def newest_user_post(user):
+    return _newest(
+        sa.select(Post.id, Post.timestamp)
+        .where(Post.user_id == user.id)
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+    )
+
+
+def newest_post():
+    return _newest(
+        sa.select(Post.id, Post.timestamp).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        )
+    )
@@ -1,3 +1,4 @@
+from flask import request
 from flask_babel import _, lazy_gettext as _l
 from flask_wtf import FlaskForm
 from wtforms import BooleanField, PasswordField, StringField, SubmitField, TextAreaField
@@ -81,3 +82,15 @@ class ResetPasswordForm(FlaskForm):
 class ResetPasswordRequestForm(FlaskForm):
     email = StringField(_l("Email"), validators=[DataRequired(), Email()])
     submit = SubmitField(_l("Request Password Reset"))
+
+
+class SearchForm(FlaskForm):
+    q = StringField(_l("Search"), validators=[DataRequired()])
+
+    def __init__(self, *args, **kwargs):
+        # Searches are GET requests with the query in the URL, so they can be linked and paged
+        if "formdata" not in kwargs:
+            kwargs["formdata"] = request.args
+        if "meta" not in kwargs:
+            kwargs["meta"] = {"csrf": False}
+        super().__init__(*args, **kwargs)
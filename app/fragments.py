@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU of rendered _post.html fragments."""
+
+    def __init__(self, size):
+        self.size = size
+        # key -> (html, author id), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, html, author_id):
+        with self._lock:
+            self._entries[key] = (html, author_id)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate_author(self, author_id):
+        with self._lock:
+            for key in [k for k, (_html, a) in self._entries.items() if a == author_id]:
+                del self._entries[key]
+
+    def info(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_size": self.size,
+            }
+
+
+def init_app(app):
+    app.extensions["post_fragments"] = FragmentCache(
+        app.config["POST_FRAGMENT_CACHE_SIZE"]
+    )
+
+
+def get_cache():
+    return current_app.extensions["post_fragments"]
+
+
+def invalidate_author(author_id):
+    get_cache().invalidate_author(author_id)
+
+
+def render_post(post):
+    cache = get_cache()
+    if not cache.size:
+        return Markup(render_template("_post.html", post=post))
+    # Post bodies never change, but everything else the fragment shows is part of the key
+    author = post.author
+    key = (post.id, g.locale, post.language, author.username, author.email_hash)
+    html = cache.get(key)
+    if html is None:
+        html = Markup(render_template("_post.html", post=post))
+        cache.set(key, html, author.id)
+    return html
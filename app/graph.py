@@ -0,0 +1,186 @@
+import threading
+import time
+from array import array
+from collections import Counter
+
+from flask import current_app
+from flask_login import current_user
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app import db
+from app.models import User, followers
+
+
+def load_csr():
+    # Compressed sparse rows: the accounts user u follows are targets[offsets[u]:offsets[u + 1]].
+    # Two flat arrays of 32 bit ints, about 4 bytes per edge plus 4 per user, read in one pass
+    # over the followers primary key, which is already in (follower_id, followed_id) order
+    max_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    offsets = array("i", [0]) * (max_id + 2)
+    targets = array("i")
+    query = (
+        sa.select(followers.c.follower_id, followers.c.followed_id)
+        .order_by(followers.c.follower_id, followers.c.followed_id)
+        .execution_options(yield_per=10000)
+    )
+    for follower_id, followed_id in db.session.execute(query):
+        targets.append(followed_id)
+        offsets[follower_id + 1] += 1
+    for i in range(1, len(offsets)):
+        offsets[i] += offsets[i - 1]
+    return offsets, targets
+
+
+class FollowGraph:
+    """The follow graph in memory, for suggestions that would be a costly self-join in SQL."""
+
+    def __init__(self, resync):
+        self.resync = resync
+        self._offsets = None
+        self._targets = None
+        # Follows and unfollows since the arrays were built, applied on top of them
+        self._added = {}
+        self._removed = {}
+        # While a rebuild is reading the table, changes are also logged to replay on the new arrays
+        self._log = None
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        with self._lock:
+            self._log = []
+        offsets, targets = load_csr()
+        with self._lock:
+            self._offsets, self._targets = offsets, targets
+            self._added, self._removed = {}, {}
+            # The rebuild may or may not have seen these, applying them again is harmless
+            for change in self._log:
+                self._apply(*change)
+            self._log = None
+            self._built_at = time.monotonic()
+
+    def _build_in_background(self, app):
+        with app.app_context():
+            try:
+                self.build()
+            except Exception:
+                app.logger.exception("Failed to build the follow graph")
+                with self._lock:
+                    self._log = None
+
+    def maybe_resync(self):
+        # Follows made in other workers show up here at the next resync
+        with self._lock:
+            if self._log is not None or (
+                self._built_at is not None
+                and time.monotonic() - self._built_at < self.resync
+            ):
+                return
+            # Claim the rebuild, build() sets it again, this only keeps a second thread out
+            self._log = []
+        threading.Thread(
+            target=self._build_in_background,
+            args=(current_app._get_current_object(),),
+            daemon=True,
+        ).start()
+
+    def _apply(self, follower_id, followed_id, following):
+        if following:
+            self._removed.get(follower_id, set()).discard(followed_id)
+            self._added.setdefault(follower_id, set()).add(followed_id)
+        else:
+            self._added.get(follower_id, set()).discard(followed_id)
+            self._removed.setdefault(follower_id, set()).add(followed_id)
+
+    def follow(self, follower_id, followed_id, following=True):
+        with self._lock:
+            self._apply(follower_id, followed_id, following)
+            if self._log is not None:
+                self._log.append((follower_id, followed_id, following))
+
+    def unfollow(self, follower_id, followed_id):
+        self.follow(follower_id, followed_id, following=False)
+
+    def _following(self, user_id):
+        # Call with the lock held
+        if user_id + 1 < len(self._offsets):
+            base = self._targets[self._offsets[user_id] : self._offsets[user_id + 1]]
+        else:
+            # Signed up after the arrays were built
+            base = ()
+        if user_id not in self._added and user_id not in self._removed:
+            return base
+        return (set(base) - self._removed.get(user_id, set())) | self._added.get(
+            user_id, set()
+        )
+
+    def suggestions(self, user_id, count):
+        # [(user id, number of people user_id follows who follow them)], most mutual follows first
+        with self._lock:
+            if self._offsets is None:
+                return []
+            following = set(self._following(user_id))
+            mutual = Counter()
+            for followed_id in following:
+                mutual.update(self._following(followed_id))
+        for followed_id in following | {user_id}:
+            mutual.pop(followed_id, None)
+        return sorted(mutual.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+    def info(self):
+        with self._lock:
+            if self._offsets is None:
+                return {"users": 0, "edges": 0, "bytes": 0, "bytes_per_edge": 0.0}
+            edges = len(self._targets)
+            size = self._offsets.itemsize * len(self._offsets)
+            size += self._targets.itemsize * edges
+            return {
+                "users": len(self._offsets) - 1,
+                "edges": edges,
+                "bytes": size,
+                "bytes_per_edge": size / edges if edges else 0.0,
+            }
+
+
+def init_app(app):
+    # Empty until the first request that needs it starts a build in the background
+    app.extensions["follow_graph"] = FollowGraph(app.config["FOLLOW_GRAPH_RESYNC"])
+
+
+def get_graph():
+    return current_app.extensions["follow_graph"]
+
+
+# User.follow_many() and unfollow_many() note their changes on the session, whoever calls them,
+# and they reach this worker's graph only if the transaction commits
+@sa.event.listens_for(so.Session, "after_commit")
+def _apply_follows(session):
+    changes = session.info.pop("follow_changes", None)
+    if changes:
+        follow_graph = get_graph()
+        for follower_id, followed_id, following in changes:
+            follow_graph.follow(follower_id, followed_id, following)
+
+
+@sa.event.listens_for(so.Session, "after_rollback")
+def _discard_follows(session):
+    session.info.pop("follow_changes", None)
+
+
+def who_to_follow():
+    # Called from the sidebar template, so JSON and 304 responses never pay for it.
+    # Until the first build finishes in the background there are simply no suggestions
+    count = current_app.config["FOLLOW_SUGGESTIONS"]
+    if not count:
+        return []
+    graph = get_graph()
+    graph.maybe_resync()
+    mutual = dict(graph.suggestions(current_user.id, count))
+    if not mutual:
+        return []
+    users = db.session.scalars(sa.select(User).where(User.id.in_(mutual))).all()
+    return sorted(
+        [(user, mutual[user.id]) for user in users],
+        key=lambda item: (-item[1], item[0].id),
+    )
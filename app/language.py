@@ -0,0 +1,82 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post
+
+
+def _init_worker(seed):
+    from langdetect import DetectorFactory
+    from langdetect.detector_factory import init_factory
+
+    # langdetect is random by default, a fixed seed means the same text always gets the same language
+    DetectorFactory.seed = seed
+    # Load the language profiles once when the worker starts, not on its first post
+    init_factory()
+
+
+def detect_language(text):
+    # Imported on first use, most processes (the CLI, workers that only serve pages) never need it
+    from langdetect import DetectorFactory
+
+    DetectorFactory.seed = current_app.config["LANGDETECT_SEED"]
+    return _detect(text)
+
+
+def _detect(text):
+    from langdetect import LangDetectException, detect
+
+    try:
+        return detect(text)
+    except LangDetectException:
+        # "" means we tried and couldn't tell, None means detection hasn't run yet
+        return ""
+
+
+def init_app(app):
+    # The pool is started by the first post that needs detecting
+    app.extensions["language_detector"] = None
+
+
+def _get_executor():
+    executor = current_app.extensions["language_detector"]
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=current_app.config["LANGUAGE_DETECTION_WORKERS"],
+            initializer=_init_worker,
+            initargs=(current_app.config["LANGDETECT_SEED"],),
+        )
+        current_app.extensions["language_detector"] = executor
+    return executor
+
+
+def detect_later(post_id, text):
+    """Detect the language of a committed post in the worker pool and store it when done.
+
+    Returns a future that resolves to the language once it has been written to the database.
+    """
+    stored = Future()
+    # The callback runs on a thread of the pool, outside this app context
+    app = current_app._get_current_object()
+
+    def store(detected):
+        try:
+            language = detected.result()
+        except Exception:
+            app.logger.exception("Language detection failed for post %d", post_id)
+            language = ""
+        try:
+            with app.app_context():
+                db.session.execute(
+                    sa.update(Post).where(Post.id == post_id).values(language=language)
+                )
+                db.session.commit()
+        except Exception as e:
+            stored.set_exception(e)
+        else:
+            stored.set_result(language)
+
+    _get_executor().submit(_detect, text).add_done_callback(store)
+    return stored
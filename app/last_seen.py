@@ -0,0 +1,102 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app import db
+from app.models import User, remember_user
+
+
+class Pending:
+    """Last seen times waiting to be written, and the thread that writes them."""
+
+    def __init__(self):
+        # user id -> most recent time the user was seen
+        self.times = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+
+
+def init_app(app):
+    app.extensions["last_seen"] = Pending()
+
+
+def _is_fresh(last_seen, now):
+    if last_seen is None:
+        return False
+    # SQLite hands datetimes back without a timezone, they were stored as UTC
+    if last_seen.tzinfo is None:
+        last_seen = last_seen.replace(tzinfo=timezone.utc)
+    return now - last_seen < timedelta(
+        seconds=current_app.config["LAST_SEEN_GRANULARITY"]
+    )
+
+
+def record(user):
+    now = datetime.now(timezone.utc)
+    if _is_fresh(user.last_seen, now):
+        return
+    if not current_app.config["LAST_SEEN_BUFFERED"]:
+        # Write on a connection of its own, committing the session would expire current_user
+        # and cost a SELECT to reload it on the next attribute access
+        with db.engine.begin() as conn:
+            conn.execute(
+                sa.update(User.__table__)
+                .where(User.__table__.c.id == user.id)
+                .values(last_seen=now)
+            )
+        so.attributes.set_committed_value(user, "last_seen", now)
+        remember_user(user)
+        return
+    # Write behind: remember the time and let the flusher thread batch it with everyone else's
+    pending = current_app.extensions["last_seen"]
+    with pending.lock:
+        if _is_fresh(pending.times.get(user.id), now):
+            return
+        pending.times[user.id] = now
+        _start_flusher(current_app._get_current_object(), pending)
+
+
+def flush(app=None):
+    # The flusher thread and the exit hook pass the app, requests and tests have their own context
+    app = app or current_app._get_current_object()
+    pending = app.extensions["last_seen"]
+    with pending.lock:
+        batch, pending.times = pending.times, {}
+    if not batch:
+        return
+    with app.app_context():
+        try:
+            # A list of parameter dicts turns into one executemany UPDATE ... WHERE id = ?
+            db.session.execute(
+                sa.update(User),
+                [{"id": id, "last_seen": last_seen} for id, last_seen in batch.items()],
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Failed to write %d last seen times", len(batch))
+            # Put them back for the next flush, unless the user has been seen again since
+            with pending.lock:
+                for id, last_seen in batch.items():
+                    pending.times.setdefault(id, last_seen)
+
+
+def _flush_periodically(app):
+    while True:
+        time.sleep(app.config["LAST_SEEN_FLUSH_INTERVAL"])
+        flush(app)
+
+
+def _start_flusher(app, pending):
+    # Started on first use rather than at startup so each pre-forked worker gets its own thread
+    if pending.flusher is None:
+        pending.flusher = threading.Thread(
+            target=_flush_periodically, args=(app,), daemon=True
+        )
+        pending.flusher.start()
+        atexit.register(flush, app)
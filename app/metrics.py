@@ -0,0 +1,226 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import before_render_template, current_app, g, has_request_context, request
+from flask import template_rendered
+import sqlalchemy as sa
+
+from app import db
+
+
+class Histogram:
+    """A Prometheus style histogram with one series per endpoint."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # endpoint -> [count per bucket (+Inf last), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            series = self._series.get(endpoint)
+            if series is None:
+                series = self._series[endpoint] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                    0,
+                ]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for endpoint, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + [float("inf")], counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f'{self.name}_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}'
+                    )
+                lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {total}')
+                lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {count}')
+        return lines
+
+
+SECONDS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+histograms = {
+    "request_seconds": Histogram(
+        "microblog_request_seconds", "Time spent handling the request.", SECONDS
+    ),
+    "sql_statements": Histogram(
+        "microblog_request_sql_statements",
+        "SQL statements executed by the request.",
+        [0, 1, 2, 3, 5, 10, 20, 50, 100],
+    ),
+    "sql_seconds": Histogram(
+        "microblog_request_sql_seconds", "Time the request spent in SQL.", SECONDS
+    ),
+    "template_seconds": Histogram(
+        "microblog_request_template_seconds",
+        "Time the request spent rendering templates.",
+        SECONDS,
+    ),
+    "translator_seconds": Histogram(
+        "microblog_request_translator_seconds",
+        "Time the request spent waiting on the translator.",
+        SECONDS,
+    ),
+}
+
+
+def _collecting():
+    return has_request_context() and "metrics" in g
+
+
+def start_request():
+    if current_app.config["METRICS_ENABLED"]:
+        g.metrics = {
+            "start": time.perf_counter(),
+            "statements": [],
+            "sql_seconds": 0.0,
+            "template_seconds": 0.0,
+            "translator_seconds": 0.0,
+            "templates": [],
+        }
+
+
+def finish_request(response):
+    if not _collecting():
+        return response
+    m = g.pop("metrics")
+    elapsed = time.perf_counter() - m["start"]
+    endpoint = request.endpoint or "unknown"
+    histograms["request_seconds"].observe(endpoint, elapsed)
+    histograms["sql_statements"].observe(endpoint, len(m["statements"]))
+    for name in ["sql_seconds", "template_seconds", "translator_seconds"]:
+        histograms[name].observe(endpoint, m[name])
+    if elapsed > current_app.config["SLOW_REQUEST_SECONDS"]:
+        slowest = sorted(m["statements"], key=lambda s: s[1], reverse=True)[:10]
+        current_app.logger.warning(
+            "Slow request %s %s took %.3fs: %d statements (%.3fs), templates %.3fs, translator %.3fs\n%s",
+            request.method,
+            request.path,
+            elapsed,
+            len(m["statements"]),
+            m["sql_seconds"],
+            m["template_seconds"],
+            m["translator_seconds"],
+            "\n".join(
+                f"  {seconds:.4f}s {statement}" for statement, seconds in slowest
+            ),
+        )
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collecting():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collecting() and conn.info.get("query_start"):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        g.metrics["statements"].append((statement, elapsed))
+        g.metrics["sql_seconds"] += elapsed
+
+
+# Templates render inside each other (index.html renders every _post.html), only time the outermost
+def _before_render(sender, template, context, **extra):
+    if _collecting():
+        g.metrics["templates"].append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if _collecting() and g.metrics["templates"]:
+        start = g.metrics["templates"].pop()
+        if not g.metrics["templates"]:
+            g.metrics["template_seconds"] += time.perf_counter() - start
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    with app.app_context():
+        for engine in db.engines.values():
+            sa.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+
+@contextmanager
+def timed(name):
+    # with metrics.timed("translator_seconds"): ... adds the time to the current request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _collecting():
+            g.metrics[name] += time.perf_counter() - start
+
+
+def _gauges():
+    # Per-worker state of the caches and queues, imported here because they import this module
+    from app import email, fragments, translate
+
+    mail = email.stats()
+    translations = translate.get_cache().info()
+    posts = fragments.get_cache().info()
+    return [
+        (
+            "microblog_email_queue_depth",
+            "gauge",
+            "Emails waiting to be sent.",
+            mail["queued"],
+        ),
+        ("microblog_emails_sent_total", "counter", "Emails sent.", mail["sent"]),
+        (
+            "microblog_emails_dropped_total",
+            "counter",
+            "Emails dropped, queue full.",
+            mail["dropped"],
+        ),
+        (
+            "microblog_translation_cache_hits_total",
+            "counter",
+            "Translation cache hits.",
+            translations["memory_hits"] + translations["disk_hits"],
+        ),
+        (
+            "microblog_translation_cache_misses_total",
+            "counter",
+            "Translation cache misses.",
+            translations["misses"],
+        ),
+        (
+            "microblog_post_fragment_cache_hits_total",
+            "counter",
+            "Post fragment cache hits.",
+            posts["hits"],
+        ),
+        (
+            "microblog_post_fragment_cache_misses_total",
+            "counter",
+            "Post fragment cache misses.",
+            posts["misses"],
+        ),
+    ]
+
+
+def render():
+    lines = []
+    for histogram in histograms.values():
+        lines.extend(histogram.render())
+    for name, kind, help, value in _gauges():
+        lines.extend(
+            [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        )
+    return "\n".join(lines) + "\n"
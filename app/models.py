@@ -1,17 +1,28 @@
 from datetime import datetime, timezone
+from functools import lru_cache
 from hashlib import md5
+import threading
 from time import time
 from typing import Optional
 
-import jwt
+from flask import current_app
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import app
 from app import db
 from app import login
 from flask_login import UserMixin
+from app.passwords import hash_password, needs_rehash, verify_password
+
+
+def email_digest(email):
+    return md5(email.lower().encode("utf-8")).hexdigest()
+
+
+# The same few authors and sizes show up on every page, so remember the URLs
+@lru_cache(maxsize=4096)
+def avatar_url(digest, size):
+    return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
 
 
 # Followers is a self relationsal table representing a many-to-many relationship
@@ -31,6 +42,29 @@ followers = sa.Table(
     # Compound primary key means combination of these keys is unique (i.e: a user can only follow another one time)
     sa.Column("follower_id", sa.Integer, sa.ForeignKey("user.id"), primary_key=True),
     sa.Column("followed_id", sa.Integer, sa.ForeignKey("user.id"), primary_key=True),
+    # The primary key answers "who does X follow", this answers "who follows X"
+    sa.Index("ix_followers_followed_id", "followed_id"),
+)
+
+
+# Timeline is a materialized "inbox" of the posts each user sees on their home page.
+# A row is written for the author and for every follower when a post is created, so the home
+# page becomes a single indexed range scan instead of the join in User.following_posts()
+# The post timestamp is copied in so the range can be ordered without touching the post table
+# +-----------------------------+
+# |           timeline          |
+# +-----------------------------+
+# | user_id       INTEGER       |
+# | post_id       INTEGER       |
+# | timestamp     DATETIME      |
+# +-----------------------------+
+timeline = sa.Table(
+    "timeline",
+    db.metadata,
+    sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id"), primary_key=True),
+    sa.Column("post_id", sa.Integer, sa.ForeignKey("post.id"), primary_key=True),
+    sa.Column("timestamp", sa.DateTime, nullable=False),
+    sa.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp"),
 )
 
 
@@ -47,12 +81,21 @@ class User(UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    # Gravatar's md5 of the email, kept in step with email so avatars don't hash on every render
+    email_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32))
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
     posts: so.WriteOnlyMapped["Post"] = so.relationship(back_populates="author")
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(
         default=lambda: datetime.now(timezone.utc)
     )
+    # Denormalized counters so profile pages don't need to count rows on every render
+    # They are kept exact by follow(), unfollow() and add_post(), `flask counters recompute` repairs any drift
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
+    num_posts: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
+    # Bumped on every follow and unfollow, so pages built from the follow graph can tell it changed
+    follow_version: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
     following: so.WriteOnlyMapped["User"] = so.relationship(
         secondary=followers,  # Configures the association table used for this relationship
         primaryjoin=(
@@ -73,41 +116,133 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f"<User {self.username}>"
 
+    @so.validates("email")
+    def _update_email_hash(self, key, email):
+        self.email_hash = email_digest(email)
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
+        # Rows from before the email_hash migration was backfilled fall back to hashing
+        return avatar_url(self.email_hash or email_digest(self.email), size)
 
     def set_password(self, password: str) -> None:
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
+        forget_user(self.id)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        if not verify_password(self.password_hash, password):
+            return False
+        # Upgrade old hashes while we have the plain password, the caller commits
+        if needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def get_reset_password_token(self, expires_in=600):
+        # Imported here, only password resets need it and the web workers start faster without it
+        import jwt
+
         return jwt.encode(
             {"reset_password": self.id, "exp": time() + expires_in},
-            app.config["SECRET_KEY"],
+            current_app.config["SECRET_KEY"],
             algorithm="HS256",
         )
 
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
+
         try:
             # If the token is valid, the value of reset_password from the token's payload is the ID of the user
-            id = jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])[
-                "reset_password"
-            ]
+            id = jwt.decode(
+                token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
+            )["reset_password"]
         except:
             return
         return db.session.get(User, id)
 
     def follow(self, user):
-        if not self.is_following(user):
-            self.following.add(user)
+        # True if this started following user, False if it already did
+        return bool(self.follow_many([user]))
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.following.remove(user)
+        return bool(self.unfollow_many([user]))
+
+    def follow_many(self, users):
+        """Follow every one of users (User objects, or rows with an id) not already followed.
+
+        Returns the ids of the users that are newly followed, so that only those are counted.
+        """
+        # The rows are written with Core statements, which don't flush new users for their ids
+        db.session.flush()
+        ids = sorted({user.id for user in users})
+        if not ids:
+            return set()
+        followed = _insert_follows(
+            [{"follower_id": self.id, "followed_id": id} for id in ids]
+        )
+        if followed:
+            _record_follows(self.id, followed, True)
+            _adjust_counters(self.id, num_following=len(followed), follow_version=1)
+            _adjust_many_counters(followed, num_followers=1)
+            if current_app.config["MATERIALIZED_TIMELINES"]:
+                # Backfill the followed users' posts into this user's timeline
+                db.session.execute(
+                    sa.insert(timeline).from_select(
+                        ["user_id", "post_id", "timestamp"],
+                        sa.select(sa.literal(self.id), Post.id, Post.timestamp).where(
+                            Post.user_id.in_(followed)
+                        ),
+                    )
+                )
+        return followed
+
+    def unfollow_many(self, users):
+        """Stop following every one of users that is followed, returns the ids unfollowed."""
+        db.session.flush()
+        ids = sorted({user.id for user in users})
+        if not ids:
+            return set()
+        unfollowed = _delete_follows(self.id, ids)
+        if unfollowed:
+            _record_follows(self.id, unfollowed, False)
+            _adjust_counters(self.id, num_following=-len(unfollowed), follow_version=1)
+            _adjust_many_counters(unfollowed, num_followers=-1)
+            if current_app.config["MATERIALIZED_TIMELINES"]:
+                # Prune the unfollowed users' posts from this user's timeline
+                db.session.execute(
+                    sa.delete(timeline).where(
+                        timeline.c.user_id == self.id,
+                        timeline.c.post_id.in_(
+                            sa.select(Post.id).where(Post.user_id.in_(unfollowed))
+                        ),
+                    )
+                )
+        return unfollowed
+
+    def add_post(self, body, language=None):
+        post = Post(body=body, author=self, language=language)
+        db.session.add(post)
+        # Flush so a new user has an id for the counter update below, and the post has an id and
+        # timestamp to copy into the timelines
+        db.session.flush()
+        _adjust_counters(self.id, num_posts=1)
+        if current_app.config["MATERIALIZED_TIMELINES"]:
+            # Fan out on write: one timeline row for the author and one for each follower
+            db.session.execute(
+                sa.insert(timeline),
+                [{"user_id": self.id, "post_id": post.id, "timestamp": post.timestamp}],
+            )
+            db.session.execute(
+                sa.insert(timeline).from_select(
+                    ["user_id", "post_id", "timestamp"],
+                    sa.select(
+                        followers.c.follower_id,
+                        sa.literal(post.id),
+                        sa.literal(post.timestamp, sa.DateTime),
+                    ).where(followers.c.followed_id == self.id),
+                )
+            )
+        return post
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
@@ -158,6 +293,18 @@ class User(UserMixin, db.Model):
             .group_by(Post)
             # Most recent first
             .order_by(Post.timestamp.desc())
+            # Load the authors of the whole page in one extra query rather than one per post
+            .options(so.selectinload(Post.author))
+        )
+
+    def timeline_posts(self):
+        # Same posts as following_posts(), read from the materialized timeline
+        return (
+            sa.select(Post)
+            .join(timeline, timeline.c.post_id == Post.id)
+            .where(timeline.c.user_id == self.id)
+            .order_by(timeline.c.timestamp.desc())
+            .options(so.selectinload(Post.author))
         )
 
 
@@ -177,6 +324,211 @@ class Post(db.Model):
         return f"<Post {self.body}>"
 
 
+# On SQLite, post bodies are also indexed in an FTS5 full-text table for /search.
+# It is an "external content" table: it stores only the index and reads the text from post,
+# and triggers keep it in step with every insert, update and delete however the rows got there
+# +-----------------------------+
+# |      post_fts (FTS5)        |
+# +-----------------------------+
+# | rowid         = post.id     |
+# | body          (indexed)     |
+# +-----------------------------+
+POST_FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE post_fts USING fts5(body, content='post', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END",
+]
+for statement in POST_FTS_SCHEMA:
+    sa.event.listen(
+        Post.__table__, "after_create", sa.DDL(statement).execute_if(dialect="sqlite")
+    )
+# The triggers go away with the post table, the virtual table has to be dropped explicitly
+sa.event.listen(
+    Post.__table__,
+    "after_drop",
+    sa.DDL("DROP TABLE IF EXISTS post_fts").execute_if(dialect="sqlite"),
+)
+
+
+def _record_follows(follower_id, followed_ids, following):
+    # Applied to the in-memory follow graph once the session commits, see graph.py
+    db.session.info.setdefault("follow_changes", []).extend(
+        (follower_id, followed_id, following) for followed_id in followed_ids
+    )
+
+
+def _adjust_counters(user_id, **deltas):
+    _adjust_many_counters([user_id], **deltas)
+
+
+def _adjust_many_counters(user_ids, **deltas):
+    # Increment in SQL (num_x = num_x + delta) so concurrent requests can't lose updates
+    db.session.execute(
+        sa.update(User)
+        .where(User.id.in_(user_ids))
+        .values({name: getattr(User, name) + delta for name, delta in deltas.items()})
+    )
+    for user_id in user_ids:
+        forget_user(user_id)
+
+
+def _insert_follows(rows):
+    # INSERT ... ON CONFLICT DO NOTHING RETURNING: one statement that skips the follows that
+    # already exist, including ones made by a concurrent request, and reports the rest
+    dialect = db.engine.dialect
+    if dialect.name in ("sqlite", "postgresql") and dialect.insert_returning:
+        if dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        return set(
+            db.session.scalars(
+                insert(followers)
+                .values(rows)
+                .on_conflict_do_nothing()
+                .returning(followers.c.followed_id)
+            )
+        )
+    # Elsewhere look the existing follows up first, in one query for all of them
+    existing = set(
+        db.session.scalars(
+            sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == rows[0]["follower_id"],
+                followers.c.followed_id.in_([row["followed_id"] for row in rows]),
+            )
+        )
+    )
+    rows = [row for row in rows if row["followed_id"] not in existing]
+    if rows:
+        db.session.execute(sa.insert(followers), rows)
+    return {row["followed_id"] for row in rows}
+
+
+def _delete_follows(follower_id, followed_ids):
+    query = sa.delete(followers).where(
+        followers.c.follower_id == follower_id,
+        followers.c.followed_id.in_(followed_ids),
+    )
+    if db.engine.dialect.delete_returning:
+        return set(db.session.scalars(query.returning(followers.c.followed_id)))
+    existing = set(
+        db.session.scalars(
+            sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == follower_id,
+                followers.c.followed_id.in_(followed_ids),
+            )
+        )
+    )
+    db.session.execute(query)
+    return existing
+
+
+def _actual_counters():
+    # The true value of every counter, as correlated subqueries against the current user row
+    return {
+        "num_followers": sa.select(sa.func.count())
+        .where(followers.c.followed_id == User.id)
+        .scalar_subquery(),
+        "num_following": sa.select(sa.func.count())
+        .where(followers.c.follower_id == User.id)
+        .scalar_subquery(),
+        "num_posts": sa.select(sa.func.count())
+        .where(Post.user_id == User.id)
+        .scalar_subquery(),
+    }
+
+
+def recompute_counters():
+    # Returns (username, counter, stored, actual) for every counter that had drifted, then fixes them all
+    actual = _actual_counters()
+    query = sa.select(
+        User.username,
+        *[getattr(User, name) for name in actual],
+        *actual.values(),
+    ).where(sa.or_(*[getattr(User, name) != value for name, value in actual.items()]))
+    drift = []
+    for row in db.session.execute(query):
+        stored, counted = row[1 : 1 + len(actual)], row[1 + len(actual) :]
+        for name, old, new in zip(actual, stored, counted):
+            if old != new:
+                drift.append((row.username, name, old, new))
+    # One statement for the whole table, the subqueries are evaluated per row
+    db.session.execute(
+        sa.update(User).values(actual), execution_options={"synchronize_session": False}
+    )
+    return drift
+
+
+def rebuild_timelines():
+    # Recreate every timeline from the posts and followers tables
+    db.session.execute(sa.delete(timeline))
+    # Every user sees their own posts
+    db.session.execute(
+        sa.insert(timeline).from_select(
+            ["user_id", "post_id", "timestamp"],
+            sa.select(Post.user_id, Post.id, Post.timestamp),
+        )
+    )
+    # ... and the posts of everyone they follow
+    db.session.execute(
+        sa.insert(timeline).from_select(
+            ["user_id", "post_id", "timestamp"],
+            sa.select(followers.c.follower_id, Post.id, Post.timestamp).join(
+                followers, followers.c.followed_id == Post.user_id
+            ),
+        )
+    )
+
+
+_user_cache_lock = threading.Lock()
+
+
+def init_app(app):
+    # user id -> (expiry time, column values) of recently authenticated users, see load_user()
+    app.extensions["user_cache"] = {}
+
+
+def remember_user(user):
+    ttl = current_app.config["USER_CACHE_TTL"]
+    if ttl:
+        # forget_user() only reaches this worker's snapshot, so the password hash is left out
+        # and loaded from the database by whatever needs it, instead of going stale
+        values = {
+            attr.key: getattr(user, attr.key)
+            for attr in sa.inspect(User).column_attrs
+            if attr.key != "password_hash"
+        }
+        with _user_cache_lock:
+            current_app.extensions["user_cache"][user.id] = (time() + ttl, values)
+
+
+def forget_user(user_id):
+    # Call whenever a user row changes so the next request reloads it
+    with _user_cache_lock:
+        current_app.extensions["user_cache"].pop(user_id, None)
+
+
 @login.user_loader
 def load_user(id: str):
-    return db.session.get(User, int(id))
+    id = int(id)
+    with _user_cache_lock:
+        entry = (
+            current_app.extensions["user_cache"].get(id)
+            if current_app.config["USER_CACHE_TTL"]
+            else None
+        )
+    if entry is not None and entry[0] > time():
+        # Rebuild the row from the snapshot and attach it to this session without a SELECT
+        user = User(**entry[1])
+        so.make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, id)
+    if user is not None:
+        remember_user(user)
+    return user
@@ -0,0 +1,70 @@
+import base64
+import binascii
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post
+
+
+# Cursors are opaque to clients, but are just the (timestamp, id) of the post at the edge of a page
+def encode_cursor(post):
+    raw = f"{post.timestamp.isoformat()}|{post.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        # Put back the padding that encode_cursor() stripped
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        timestamp, id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        # Older posts continue before the last item, newer posts after the first one
+        self.next_cursor = encode_cursor(items[-1]) if has_next else None
+        self.prev_cursor = encode_cursor(items[0]) if has_prev else None
+
+
+def paginate_keyset(query, per_page, before=None, after=None, keys=None):
+    """Page through a newest-first query of posts without OFFSET or COUNT(*)."""
+    timestamp, id = keys if keys is not None else (Post.timestamp, Post.id)
+    before = decode_cursor(before)
+    after = None if before else decode_cursor(after)
+    # The cursor replaces whatever ordering the query came with
+    query = query.order_by(None)
+    if after:
+        # Walking towards newer posts: read upwards from the cursor, then flip the page
+        ts, pk = after
+        query = query.where(
+            sa.or_(timestamp > ts, sa.and_(timestamp == ts, id > pk))
+        ).order_by(timestamp.asc(), id.asc())
+    else:
+        if before:
+            ts, pk = before
+            query = query.where(
+                sa.or_(timestamp < ts, sa.and_(timestamp == ts, id < pk))
+            )
+        query = query.order_by(timestamp.desc(), id.desc())
+    # Fetch one extra row to learn whether there is another page in the direction of travel
+    items = db.session.scalars(query.limit(per_page + 1)).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if after:
+        items.reverse()
+    if not items:
+        return KeysetPage(items, has_next=False, has_prev=False)
+    # We got here from a cursor, so there is at least one post on the other side of it
+    has_next = True if after else more
+    has_prev = more if after else before is not None
+    return KeysetPage(items, has_next=has_next, has_prev=has_prev)
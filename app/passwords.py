@@ -0,0 +1,68 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import threading
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+_lock = threading.Lock()
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already waiting for the pool."""
+
+
+def init_app(app):
+    # The (executor, slots) pair is created on first use, in the worker process that hashes
+    app.extensions["password_pool"] = None
+
+
+def _get_pool():
+    with _lock:
+        pool = current_app.extensions["password_pool"]
+        if pool is None:
+            executor = ProcessPoolExecutor(
+                max_workers=current_app.config["PASSWORD_HASH_WORKERS"]
+            )
+            # Admission control: at most this many hashes running or queued per worker process
+            slots = threading.BoundedSemaphore(
+                current_app.config["PASSWORD_HASH_MAX_PENDING"]
+            )
+            pool = current_app.extensions["password_pool"] = (executor, slots)
+        return pool
+
+
+def _run(fn, *args):
+    if not current_app.config["PASSWORD_HASH_WORKERS"]:
+        return fn(*args)
+    # Hashing holds the GIL for a long time, so do it in another process and just wait here
+    executor, slots = _get_pool()
+    if not slots.acquire(timeout=current_app.config["PASSWORD_HASH_TIMEOUT"]):
+        raise HashingBusy()
+    try:
+        return executor.submit(fn, *args).result()
+    finally:
+        slots.release()
+
+
+@lru_cache(maxsize=8)
+def _method_prefix(method):
+    # Werkzeug fills in defaults ("scrypt" -> "scrypt:32768:8:1"), hash once to see the full name
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+def hash_password(password):
+    return _run(
+        generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"]
+    )
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    # True if the hash was made with different cost parameters than the ones configured now
+    return password_hash.split("$", 1)[0] != _method_prefix(
+        current_app.config["PASSWORD_HASH_METHOD"]
+    )
@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import deque
+from datetime import timezone
+
+from flask import current_app
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app import db
+from app.models import Post, avatar_url, email_digest
+from app.pagination import KeysetPage, decode_cursor
+
+
+def _naive_utc(timestamp):
+    # Posts read back from the database are naive UTC, a post that was just created may not be
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class RecentAuthor:
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email_hash = user.email_hash or email_digest(user.email)
+
+    def avatar(self, size):
+        return avatar_url(self.email_hash, size)
+
+
+class RecentPost:
+    # A plain copy of a post and the author fields _post.html shows, safe to share between requests
+    def __init__(self, post):
+        self.id = post.id
+        self.body = post.body
+        self.timestamp = _naive_utc(post.timestamp)
+        self.language = post.language
+        self.author = RecentAuthor(post.author)
+        self.key = (self.timestamp, self.id)
+
+
+class RecentPosts:
+    """Ring buffer of the newest posts, newest first, that serves the top of the explore page."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._posts = deque(maxlen=size)
+        # True when the buffer holds every post there is, so it can answer for the last page too
+        self._complete = False
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        # Reload from the database, this is how posts written by other workers show up
+        posts = db.session.scalars(
+            sa.select(Post)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(self.size)
+            .options(so.selectinload(Post.author))
+        ).all()
+        recent = [RecentPost(post) for post in posts]
+        with self._lock:
+            self._posts = deque(recent, maxlen=self.size)
+            self._complete = len(recent) < self.size
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def add(self, recent):
+        # Takes a RecentPost, copied before the commit expired the post's attributes
+        with self._lock:
+            if self._loaded_at is None:
+                # It will be in the database when the buffer is next loaded
+                return
+            if len(self._posts) == self.size:
+                self._complete = False
+            # With maxlen set, the oldest post falls off the other end
+            self._posts.appendleft(recent)
+
+    def snapshot(self):
+        with self._lock:
+            loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= self.ttl:
+            # One request reloads while the others keep reading the slightly stale copy,
+            # unless there is no copy at all yet
+            if self._refresh_lock.acquire(blocking=loaded_at is None):
+                try:
+                    self.refresh()
+                finally:
+                    self._refresh_lock.release()
+        with self._lock:
+            return list(self._posts), self._complete
+
+    def newest(self):
+        # (id, timestamp) of the newest post, like etags.newest_post() but from memory
+        posts, _complete = self.snapshot()
+        return (posts[0].id, posts[0].timestamp) if posts else ()
+
+    def page(self, per_page, before=None, after=None):
+        # The same pages paginate_keyset() would return, or None if they reach past the buffer
+        if not self.size:
+            return None
+        posts, complete = self.snapshot()
+        before = decode_cursor(before)
+        after = None if before else decode_cursor(after)
+        if after:
+            key = (_naive_utc(after[0]), after[1])
+            # Every post newer than the cursor is in the buffer only if the cursor is in it too
+            if not complete and (not posts or key < posts[-1].key):
+                return None
+            newer = [post for post in posts if post.key > key]
+            items = newer[-per_page:]
+            if not items:
+                return KeysetPage(items, has_next=False, has_prev=False)
+            return KeysetPage(items, has_next=True, has_prev=len(newer) > per_page)
+        if before:
+            key = (_naive_utc(before[0]), before[1])
+            older = [post for post in posts if post.key < key]
+        else:
+            older = posts
+        # A full page plus one more to know there is a next page, or the end of all posts
+        if len(older) <= per_page and not complete:
+            return None
+        items = older[:per_page]
+        if not items:
+            return KeysetPage(items, has_next=False, has_prev=False)
+        return KeysetPage(
+            items, has_next=len(older) > per_page, has_prev=before is not None
+        )
+
+
+def init_app(app):
+    app.extensions["recent_posts"] = RecentPosts(
+        app.config["EXPLORE_BUFFER_SIZE"], app.config["EXPLORE_BUFFER_TTL"]
+    )
+
+
+def get_buffer():
+    return current_app.extensions["recent_posts"]
@@ -0,0 +1,54 @@
+import random
+from time import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+
+
+class RoutingSession(Session):
+    """Sends the SELECTs of read-only requests to a replica, everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and isinstance(clause, (sa.Select, sa.CompoundSelect))
+            and has_request_context()
+            and g.get("replica")
+        ):
+            return self._db.engines[g.replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_primary(f):
+    # For GET routes that must see their own writes, or the freshest data, every time
+    f.use_primary = True
+    return f
+
+
+def choose_bind():
+    # Called at the start of every request to decide where its reads go
+    g.replica = None
+    replicas = current_app.config["REPLICA_BINDS"]
+    if not replicas or request.method not in ("GET", "HEAD"):
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    if view is None or getattr(view, "use_primary", False):
+        return
+    # Read your writes: replicas may not have caught up with what this client just did
+    if session.get("primary_until", 0) > time():
+        return
+    g.replica = random.choice(replicas)
+
+
+def pinned_to_primary():
+    # True when there are replicas but this request has to read from the primary
+    return bool(current_app.config["REPLICA_BINDS"]) and not g.get("replica")
+
+
+def stick_to_primary(response):
+    # Any request that could have written something pins the client to the primary for a while
+    if current_app.config["REPLICA_BINDS"] and request.method not in ("GET", "HEAD"):
+        session["primary_until"] = time() + current_app.config["REPLICA_STICKY_SECONDS"]
+    return response
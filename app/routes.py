@@ -1,75 +1,149 @@
-from datetime import datetime, timezone
-
-from flask import g, render_template, flash, redirect, request, url_for
+from datetime import timezone
+import hmac
+from flask import abort, g, jsonify, make_response, render_template, flash, redirect
+from flask import Blueprint, Response, current_app, request, url_for
 from flask_babel import _, get_locale
-from flask_login import current_user, login_required, login_user, logout_user
+from flask_login import current_user, login_required
 import sqlalchemy as sa
-from urllib.parse import urlsplit
-from langdetect import detect, LangDetectException
+import sqlalchemy.orm as so
 
-from app import app
 from app import db
-from app.email import send_password_reset_email
+from app import etags
+from app import fragments
+from app import graph
+from app import language
+from app import metrics
+from app import recent
+from app import last_seen
+from app import replicas
+from app import stream
 from app.forms import (
     EditProfileForm,
     EmptyForm,
-    LoginForm,
     PostForm,
-    RegistrationForm,
-    ResetPasswordForm,
-    ResetPasswordRequestForm,
+    SearchForm,
 )
-from app.models import Post, User
-from app.translate import translate
+from app.models import Post, User, forget_user, timeline
+from app.pagination import paginate_keyset
+from app.recent import RecentPost
+from app.search import search_posts
+from app.translate import get_cache, translate, translate_many
+
+bp = Blueprint("main", __name__)
+# Called from the templates, registered here so every app the factory builds gets them
+bp.add_app_template_global(fragments.render_post)
+bp.add_app_template_global(graph.who_to_follow)
 
 
-@app.before_request
+@bp.before_app_request
 def before_request():
+    # Before anything touches the database, so loading the user can go to a replica too
+    replicas.choose_bind()
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        # We don't need to add user here because we know it's already in the db (else there wouldn't be a current user)
-        db.session.commit()
+        last_seen.record(current_user)
+        g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
-@app.route("/", methods=["GET", "POST"])
-@app.route("/index", methods=["GET", "POST"])
+@bp.after_app_request
+def after_request(response):
+    return replicas.stick_to_primary(response)
+
+
+def post_json(post):
+    timestamp = post.timestamp
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {
+        "id": post.id,
+        "body": post.body,
+        "timestamp": timestamp.isoformat(),
+        "language": post.language,
+        "author": {"username": post.author.username, "avatar": post.author.avatar(70)},
+    }
+
+
+def timeline_response(etag, posts, endpoint, template, username=None, **context):
+    # Timelines render as HTML, or as JSON for clients that poll them with ?format=json
+    format = request.args.get("format")
+    next_url = prev_url = None
+    if posts.has_next:
+        next_url = url_for(
+            endpoint, username=username, before=posts.next_cursor, format=format
+        )
+    if posts.has_prev:
+        prev_url = url_for(
+            endpoint, username=username, after=posts.prev_cursor, format=format
+        )
+    if format == "json":
+        response = jsonify(
+            posts=[post_json(post) for post in posts.items],
+            next_url=next_url,
+            prev_url=prev_url,
+        )
+    else:
+        response = make_response(
+            render_template(
+                template,
+                posts=posts.items,
+                next_url=next_url,
+                prev_url=prev_url,
+                **context,
+            )
+        )
+    return etags.tag(response, etag)
+
+
+@bp.route("/", methods=["GET", "POST"])
+@bp.route("/index", methods=["GET", "POST"])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ""
-        post = Post(body=form.post.data, author=current_user, language=language)
-        db.session.add(post)
+        if current_app.config["LANGUAGE_DETECTION_ASYNC"]:
+            # Insert right away with the language pending, the worker pool fills it in
+            post = current_user.add_post(form.post.data)
+        else:
+            post = current_user.add_post(
+                form.post.data, language=language.detect_language(form.post.data)
+            )
+        # Flush for the id and timestamp, so they can be read without reloading the post after the commit
+        db.session.flush()
+        recent_post = RecentPost(post)
         db.session.commit()
+        recent.get_buffer().add(recent_post)
+        stream.publish()
+        if current_app.config["LANGUAGE_DETECTION_ASYNC"]:
+            language.detect_later(recent_post.id, recent_post.body)
         flash(_("Your post is now live!"))
         # The redirect here is useful to avoid refreshing a post request, which would have the user re-submit a post. Instead, redirect to a GET so refresh works
         # Posts/Redirect/Get pattern
-        return redirect(url_for("index"))
-
-    page = request.args.get("page", 1, type=int)
-    posts = db.paginate(
-        current_user.following_posts(),
-        page=page,
-        per_page=app.config["POSTS_PER_PAGE"],
-        error_out=False,
+        return redirect(url_for("main.index"))
+
+    # Checked before the timeline is read or rendered, which is most of the cost of the page
+    etag = etags.make_etag(etags.newest_home_post(current_user))
+    response = etags.not_modified(etag)
+    if response is not None:
+        return response
+    if current_app.config["MATERIALIZED_TIMELINES"]:
+        query = current_user.timeline_posts()
+        keys = (timeline.c.timestamp, timeline.c.post_id)
+    else:
+        query = current_user.following_posts()
+        keys = None
+    posts = paginate_keyset(
+        query,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before"),
+        after=request.args.get("after"),
+        keys=keys,
     )
-    next_url = url_for("index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("index", page=posts.prev_num) if posts.has_prev else None
-    return render_template(
-        "index.html",
-        title="Home Page",
-        form=form,
-        posts=posts.items,
-        next_url=next_url,
-        prev_url=prev_url,
+    return timeline_response(
+        etag, posts, "main.index", "index.html", title="Home Page", form=form
     )
 
 
-@app.route("/edit_profile", methods=["GET", "POST"])
+@bp.route("/edit_profile", methods=["GET", "POST"])
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.username)
@@ -77,114 +151,151 @@ def edit_profile():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        forget_user(current_user.id)
+        # Cached posts show the old username
+        fragments.invalidate_author(current_user.id)
+        recent.get_buffer().invalidate()
         flash(_("Your changes have been saved."))
-        return redirect(url_for("edit_profile"))
+        return redirect(url_for("main.edit_profile"))
     elif request.method == "GET":
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
     return render_template("edit_profile.html", title="Edit Profile", form=form)
 
 
-@app.route("/explore")
+@bp.route("/explore")
 @login_required
 def explore():
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    page = request.args.get("page", 1, type=int)
-    posts = db.paginate(
-        query, page=page, per_page=app.config["POSTS_PER_PAGE"], error_out=False
-    )
-    next_url = url_for("explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("explore", page=posts.prev_num) if posts.has_prev else None
+    before, after = request.args.get("before"), request.args.get("after")
+    # The first pages are the same for everyone, serve them from memory when the buffer reaches.
+    # The buffer may have been loaded from a replica, so not to clients that must see their writes
+    buffer = None if replicas.pinned_to_primary() else recent.get_buffer()
+    if buffer is not None and buffer.size:
+        etag = etags.make_etag(buffer.newest())
+    else:
+        etag = etags.make_etag(etags.newest_post())
+    response = etags.not_modified(etag)
+    if response is not None:
+        return response
+    posts = None
+    if buffer is not None:
+        posts = buffer.page(current_app.config["POSTS_PER_PAGE"], before, after)
+    if posts is None:
+        query = (
+            sa.select(Post)
+            .order_by(Post.timestamp.desc())
+            .options(so.selectinload(Post.author))
+        )
+        posts = paginate_keyset(
+            query,
+            per_page=current_app.config["POSTS_PER_PAGE"],
+            before=before,
+            after=after,
+        )
     # We use the same template as the homepage here, but show all posts regardless of following
-    return render_template(
-        "index.html",
-        title="Explore",
-        posts=posts.items,
-        next_url=next_url,
-        prev_url=prev_url,
-    )
+    return timeline_response(etag, posts, "main.explore", "index.html", title="Explore")
 
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    form = LoginForm()
-    if form.validate_on_submit():
-        user = db.session.scalar(
-            sa.select(User).where(User.username == form.username.data)
+@bp.route("/events")
+@login_required
+def post_events():
+    # Pushes the ids of new posts on the home page, instead of clients reloading it to find out
+    user_id = current_user.id
+    try:
+        messages = stream.subscribe(user_id)
+    except stream.TooManyStreams:
+        return Response(status=503, headers={"Retry-After": "30"})
+    missed = []
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    if last_event_id is not None:
+        # A reconnecting client gets what it missed while it was away
+        query = (
+            current_user.following_posts()
+            .where(Post.id > last_event_id)
+            .order_by(None)
+            .order_by(Post.id)
+            .limit(100)
+            .options(so.selectinload(Post.author))
         )
-        if user is None or not user.check_password(form.password.data):
-            flash(_("Invalid username or password"))
-            return redirect(url_for("login"))
-        login_user(user, remember=form.remember_me.data)
-        # If a non-logged in-user tries to access /index, it'll add the query to url as such: /login?next=/index
-        next_page = request.args.get("next")
-        # netloc gets domain name of url (ex: example.com/path.netloc -> example.com)
-        # this check avoid redirecting to external site which would be an avenue for a phishing attack (open redirect)
-        if not next_page or urlsplit(next_page).netloc != "":
-            next_page = url_for("index")
-        return redirect(next_page)
-    return render_template("login.html", title="Sign In", form=form)
-
-
-@app.route("/logout")
-def logout():
-    logout_user()
-    return redirect(url_for("index"))
-
-
-@app.route("/register", methods=["GET", "POST"])
-def register():
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    form = RegistrationForm()
-    # Was the form submitted (is this a post request), and did all the validators pass
-    if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
-        db.session.add(user)
-        db.session.commit()
-        flash(_("Good job, you signed up. Whoopie."))
-        return redirect(url_for("login"))
-    return render_template("register.html", title="Register", form=form)
+        missed = [
+            {"id": post.id, "author": post.author.username}
+            for post in db.session.scalars(query)
+        ]
+    # The stream stays open for a long time, it must not hold on to a database connection
+    db.session.close()
+    return Response(
+        stream.events(
+            stream.get_streams(),
+            user_id,
+            messages,
+            missed,
+            current_app.config["STREAM_HEARTBEAT"],
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@bp.route("/search")
+@login_required
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for("main.explore"))
+    q = g.search_form.q.data
+    language = request.args.get("language")
+    posts = search_posts(
+        q,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        cursor=request.args.get("cursor"),
+        language=language,
+    )
+    next_url = (
+        url_for("main.search", q=q, language=language, cursor=posts.next_cursor)
+        if posts.next_cursor
+        else None
+    )
+    return render_template(
+        "search.html", title=_("Search"), posts=posts.items, next_url=next_url
+    )
 
 
 # When a url component contains < >, the text portion is passed in as a parameter of the same name, in this case, username
-@app.route("/user/<username>")
+@bp.route("/user/<username>")
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get("page", 1, type=int)
+    etag = etags.make_etag(
+        user.id,
+        user.username,
+        user.about_me,
+        user.last_seen,
+        user.num_followers,
+        user.num_following,
+        etags.newest_user_post(user),
+    )
+    response = etags.not_modified(etag)
+    if response is not None:
+        return response
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(
+    posts = paginate_keyset(
         query,
-        page=page,
-        per_page=app.config["POSTS_PER_PAGE"],
-        error_out=False,
-    )
-    next_url = (
-        url_for("user", username=user.username, page=posts.next_num)
-        if posts.has_next
-        else None
-    )
-    prev_url = (
-        url_for("user", username=user.username, page=posts.prev_num)
-        if posts.has_prev
-        else None
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before"),
+        after=request.args.get("after"),
     )
     form = EmptyForm()
-    return render_template(
+    return timeline_response(
+        etag,
+        posts,
+        "main.user",
         "user.html",
+        username=user.username,
         user=user,
-        posts=posts.items,
         form=form,
-        next_url=next_url,
-        prev_url=prev_url,
     )
 
 
-@app.route("/follow/<username>", methods=["POST"])
+@bp.route("/follow/<username>", methods=["POST"])
 @login_required
 def follow(username):
     form = EmptyForm()
@@ -192,23 +303,25 @@ def follow(username):
         user = db.session.scalar(sa.select(User).where(User.username == username))
         if user is None:
             flash(_("User %(username)s not found.", username=username))
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         if user == current_user:
             flash(
                 _(
                     "You're so vain. You can't follow yourself. Get your head out of your ass."
                 )
             )
-            return redirect(url_for("user", username=username))
-        current_user.follow(user)
-        db.session.commit()
+            return redirect(url_for("main.user", username=username))
+        # No need to check first, a follow that already exists is skipped by the insert.
+        # The commit also adds it to the follow graph
+        if current_user.follow(user):
+            db.session.commit()
         flash(_("You are now following %(username)s!", username=username))
-        return redirect(url_for("user", username=username))
+        return redirect(url_for("main.user", username=username))
     else:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
 
-@app.route("/unfollow/<username>", methods=["POST"])
+@bp.route("/unfollow/<username>", methods=["POST"])
 @login_required
 def unfollow(username):
     form = EmptyForm()
@@ -216,54 +329,132 @@ def unfollow(username):
         user = db.session.scalar(sa.select(User).where(User.username == username))
         if user is None:
             flash(_("User %(username)s not found.", username=username))
-            return redirect(url_for("index"))
+            return redirect(url_for("main.index"))
         if user == current_user:
             flash(_("You can't unfollow yourself."))
-            return redirect(url_for("user", username=username))
-        current_user.unfollow(user)
-        db.session.commit()
+            return redirect(url_for("main.user", username=username))
+        if current_user.unfollow(user):
+            db.session.commit()
         flash(_("You are not following %(username)s.", username=username))
-        return redirect(url_for("user", username=username))
+        return redirect(url_for("main.user", username=username))
     else:
-        return redirect(url_for("index"))
+        return redirect(url_for("main.index"))
 
 
-@app.route("/reset_password/<token>", methods=["GET", "POST"])
-def reset_password(token):
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    user = User.verify_reset_password_token(token)
-    if not user:
-        return redirect(url_for("index"))
-    form = ResetPasswordForm()
-    if form.validate_on_submit():
-        user.set_password(form.password.data)
-        db.session.commit()
-        flash(_("Your password has been reset."))
-        return redirect(url_for("login"))
-    return render_template("reset_password.html", form=form)
+def change_follows(following):
+    # Body: {"usernames": ["susan", "mary", ...]}, answers with what happened to each of them
+    data = request.get_json(silent=True)
+    usernames = data.get("usernames") if isinstance(data, dict) else None
+    if not isinstance(usernames, list) or not all(
+        isinstance(username, str) for username in usernames
+    ):
+        return {"error": "expected a list of usernames"}, 400
+    if len(usernames) > current_app.config["FOLLOW_BATCH_SIZE"]:
+        return {"error": "too many usernames"}, 400
+    # One query for all the ids, and one statement to (un)follow all of them
+    users = db.session.execute(
+        sa.select(User.id, User.username).where(User.username.in_(usernames))
+    ).all()
+    follower_id = current_user.id
+    others = [user for user in users if user.id != follower_id]
+    if following:
+        changed = current_user.follow_many(others)
+        outcomes = ("followed", "already following")
+    else:
+        changed = current_user.unfollow_many(others)
+        outcomes = ("unfollowed", "not following")
+    db.session.commit()
+    results = {username: "not found" for username in usernames}
+    for user in users:
+        if user.id == follower_id:
+            results[user.username] = "self"
+        else:
+            results[user.username] = outcomes[0 if user.id in changed else 1]
+    return {"results": results}
 
 
-@app.route("/reset_password_request", methods=["GET", "POST"])
-def reset_password_request():
-    if current_user.is_authenticated:
-        return redirect(url_for("index"))
-    form = ResetPasswordRequestForm()
-    if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.email == form.email.data))
-        if user:
-            send_password_reset_email(user)
-        flash(_("Check your email for the instructions to reset your password"))
-        return redirect(url_for("login"))
-    return render_template(
-        "reset_password_request.html", title="Reset Password", form=form
-    )
+@bp.route("/follow", methods=["POST"])
+@login_required
+def follow_many():
+    return change_follows(following=True)
+
+
+@bp.route("/unfollow", methods=["POST"])
+@login_required
+def unfollow_many():
+    return change_follows(following=False)
 
 
-@app.route("/translate", methods=["POST"])
+@bp.route("/translate", methods=["POST"])
 @login_required
 def translate_text():
     data = request.get_json()
     return {
         "text": translate(data["text"], data["source_language"], data["dest_language"])
     }
+
+
+@bp.route("/translate/batch", methods=["POST"])
+@login_required
+def translate_batch():
+    # Body: {"items": [{"post_id": 1, "source_language": "es", "dest_language": "en"}, ...]}
+    data = request.get_json(silent=True)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(
+        isinstance(item, dict)
+        and isinstance(item.get("post_id"), int)
+        and isinstance(item.get("dest_language"), str)
+        and isinstance(item.get("source_language"), (str, type(None)))
+        for item in items
+    ):
+        return {"error": "expected a list of items"}, 400
+    if len(items) > current_app.config["TRANSLATOR_BATCH_SIZE"]:
+        return {"error": "too many items"}, 400
+    # One query for all the post bodies instead of having the client send them
+    posts = {
+        post.id: post
+        for post in db.session.scalars(
+            sa.select(Post).where(Post.id.in_([item["post_id"] for item in items]))
+        )
+    }
+    items = [item for item in items if item["post_id"] in posts]
+    translations = translate_many(
+        [
+            (
+                posts[item["post_id"]].body,
+                item.get("source_language") or posts[item["post_id"]].language,
+                item["dest_language"],
+            )
+            for item in items
+        ]
+    )
+    error = _("Error: the translation service failed.")
+    return {
+        "translations": {
+            str(item["post_id"]): text if text is not None else error
+            for item, text in zip(items, translations)
+        }
+    }
+
+
+@bp.route("/translate/stats")
+@login_required
+def translate_stats():
+    # Hit and miss counts for this worker's translation cache, to help size it
+    return get_cache().info()
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    if not current_app.config["METRICS_ENABLED"]:
+        abort(404)
+    # Request counts and queue depths are nobody else's business
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        if not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            return "", 401, {"WWW-Authenticate": "Bearer"}
+    elif request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
@@ -0,0 +1,122 @@
+import base64
+import binascii
+import time
+
+from flask import current_app
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app import db
+from app.models import Post
+
+post_fts = sa.table("post_fts", sa.column("rowid"))
+
+
+def has_index():
+    return db.engine.dialect.name == "sqlite"
+
+
+def match_expression(q):
+    # Quote every word, so input like 'AND', 'foo*' or a stray '"' is searched for, not parsed
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.split()]
+    return " ".join(terms) or None
+
+
+# Cursors are the (score, id) of the last result, plus the moment the search started so the
+# recency part of the score is computed the same way on every page
+def encode_cursor(score, id, now):
+    raw = f"{score!r}|{id}|{now!r}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        score, id, now = raw.split("|")
+        return float(score), int(id), float(now)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class SearchPage:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def search_posts(q, per_page, cursor=None, language=None):
+    """Posts matching q, best first, ranked by bm25 and how recent they are."""
+    match = match_expression(q)
+    cursor = decode_cursor(cursor)
+    if match is None:
+        return SearchPage([], None)
+    # Julian day, which is what SQLite's julianday() returns for the post timestamps
+    now = cursor[2] if cursor else time.time() / 86400 + 2440587.5
+    if has_index():
+        # bm25() is negative, closer to zero is a worse match. Dividing by the age in units of
+        # SEARCH_RECENCY_DAYS pulls older posts towards zero, so the lowest score ranks first
+        age = (now - sa.func.julianday(Post.timestamp)) / current_app.config[
+            "SEARCH_RECENCY_DAYS"
+        ]
+        score = sa.func.bm25(sa.literal_column("post_fts")) / (1 + age)
+        matches = (
+            sa.select(post_fts.c.rowid.label("id"), score.label("score"))
+            .join(Post, Post.id == post_fts.c.rowid)
+            .where(sa.literal_column("post_fts").op("MATCH")(match))
+        )
+    else:
+        # No full-text index on this database, fall back to a scan ordered by recency alone
+        matches = sa.select(Post.id, sa.literal(0.0).label("score")).where(
+            *[Post.body.icontains(term, autoescape=True) for term in q.split()]
+        )
+    if language:
+        matches = matches.where(Post.language == language)
+    matches = matches.subquery()
+    query = (
+        sa.select(Post, matches.c.score)
+        .join(matches, matches.c.id == Post.id)
+        .options(so.selectinload(Post.author))
+    )
+    if cursor:
+        score, id = cursor[0], cursor[1]
+        query = query.where(
+            sa.or_(
+                matches.c.score > score,
+                sa.and_(matches.c.score == score, Post.id < id),
+            )
+        )
+    query = query.order_by(matches.c.score, Post.id.desc()).limit(per_page + 1)
+    rows = db.session.execute(query).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].Post.id, now)
+    return SearchPage([row.Post for row in rows], next_cursor)
+
+
+def rebuild_index(batch_size, progress=None):
+    # Index the posts that existed before the triggers did, a batch per transaction
+    if not has_index():
+        return 0
+    db.session.execute(sa.text("INSERT INTO post_fts(post_fts) VALUES ('delete-all')"))
+    # Read in the same write transaction as the delete, posts after this are indexed by the triggers
+    last_id = db.session.scalar(sa.select(sa.func.max(Post.id))) or 0
+    db.session.commit()
+    done, start = 0, 0
+    while start < last_id:
+        end = min(start + batch_size, last_id)
+        result = db.session.execute(
+            sa.text(
+                "INSERT INTO post_fts(rowid, body) "
+                "SELECT id, body FROM post WHERE id > :start AND id <= :end"
+            ),
+            {"start": start, "end": end},
+        )
+        db.session.commit()
+        done += result.rowcount
+        start = end
+        if progress:
+            progress(done)
+    return done
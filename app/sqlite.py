@@ -0,0 +1,14 @@
+import sqlalchemy as sa
+
+
+def apply_pragmas(engine, pragmas):
+    """Run PRAGMA name=value for every setting in pragmas on each new connection to a SQLite engine."""
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @sa.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
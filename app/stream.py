@@ -0,0 +1,144 @@
+import json
+import queue
+import threading
+from collections import defaultdict
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import db
+from app.models import Post, User, followers
+
+
+class Streams:
+    """The event streams open in this worker, and the thread that feeds them new posts."""
+
+    def __init__(self):
+        # user id -> queues of the event streams that user has open
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+        self.poller = None
+        # Set to run the poller right away instead of at the end of its interval
+        self.wakeup = threading.Event()
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def init_app(app):
+    app.extensions["event_streams"] = Streams()
+
+
+def get_streams():
+    return current_app.extensions["event_streams"]
+
+
+def subscribe(user_id):
+    streams = get_streams()
+    messages = queue.Queue(maxsize=100)
+    with streams.lock:
+        if (
+            sum(len(s) for s in streams.subscribers.values())
+            >= current_app.config["STREAM_MAX_CONNECTIONS"]
+        ):
+            raise TooManyStreams()
+        streams.subscribers[user_id].add(messages)
+        if streams.poller is None:
+            # Started on first use so each pre-forked worker process runs its own
+            streams.poller = threading.Thread(
+                target=_poll,
+                args=(current_app._get_current_object(), streams),
+                daemon=True,
+            )
+            streams.poller.start()
+    return messages
+
+
+def unsubscribe(streams, user_id, messages):
+    with streams.lock:
+        streams.subscribers[user_id].discard(messages)
+        if not streams.subscribers[user_id]:
+            del streams.subscribers[user_id]
+
+
+def publish():
+    # A post was just committed in this worker, deliver it now rather than at the next poll
+    get_streams().wakeup.set()
+
+
+def _poll(app, streams):
+    # Every post reaches the streams through here, whichever worker created it: new rows are found
+    # by id, so the only state is the highest id delivered so far
+    last_id = None
+    while True:
+        with app.app_context():
+            try:
+                if last_id is None:
+                    # Streams start with the posts made after the poller did
+                    last_id = db.session.scalar(sa.select(sa.func.max(Post.id))) or 0
+                else:
+                    last_id = _deliver(streams, last_id)
+            except Exception:
+                # Tried again at the next poll, an exception must not end the thread
+                app.logger.exception("Failed to deliver new posts to event streams")
+        streams.wakeup.wait(app.config["STREAM_POLL_INTERVAL"])
+        streams.wakeup.clear()
+
+
+def _deliver(streams, last_id):
+    rows = db.session.execute(
+        sa.select(Post.id, Post.user_id, User.username)
+        .join(Post.author)
+        .where(Post.id > last_id)
+        .order_by(Post.id)
+        .limit(1000)
+    ).all()
+    if not rows:
+        return last_id
+    with streams.lock:
+        subscribers = {user_id: set(s) for user_id, s in streams.subscribers.items()}
+    if subscribers:
+        # One query for who, among the connected users, follows any of the authors
+        authors = {row.user_id for row in rows}
+        audience = defaultdict(set)
+        for follower_id, followed_id in db.session.execute(
+            sa.select(followers.c.follower_id, followers.c.followed_id).where(
+                followers.c.followed_id.in_(authors),
+                followers.c.follower_id.in_(subscribers),
+            )
+        ):
+            audience[followed_id].add(follower_id)
+        for row in rows:
+            event = {"id": row.id, "author": row.username}
+            # Authors see their own posts on their home page too
+            for user_id in audience[row.user_id] | {row.user_id}:
+                for messages in subscribers.get(user_id, ()):
+                    try:
+                        messages.put_nowait(event)
+                    except queue.Full:
+                        # A client that stopped reading, it will catch up with Last-Event-ID
+                        pass
+    return rows[-1].id
+
+
+def events(streams, user_id, messages, missed=(), heartbeat=15):
+    # Server-Sent Events for one client, ends when the client disconnects. It runs after the view
+    # has returned, outside the app context, so the view passes in everything it needs
+    try:
+        for event in missed:
+            yield format_event(event)
+        while True:
+            try:
+                event = messages.get(timeout=heartbeat)
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection, and notices dead clients
+                yield ": heartbeat\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        unsubscribe(streams, user_id, messages)
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: post\ndata: {json.dumps(event)}\n\n"
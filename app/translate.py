@@ -1,23 +1,297 @@
-import requests
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
 from flask_babel import _
-from app import app
+from app import metrics
+
+
+class TranslationCache:
+    """Two tier cache of translations: an in-process LRU in front of an optional SQLite file."""
+
+    # Seconds between deletes of expired rows from the SQLite file, by whichever worker writes
+    prune_interval = 60
+
+    def __init__(self, size, ttl, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self._pruned_at = 0.0
+        # key -> (translation, time it was stored), least recently used first
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # sqlite3 connections can't be shared between threads, so each thread opens its own
+        self._local = threading.local()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            # WAL lets every worker process read the file while one of them writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS translation "
+                "(key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS translation_created ON translation (created)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[0]
+        if self.path:
+            row = (
+                self._db()
+                .execute(
+                    "SELECT text, created FROM translation WHERE key = ? AND created > ?",
+                    (key, now - self.ttl),
+                )
+                .fetchone()
+            )
+            if row is not None:
+                # Keeps the time it was stored, so it expires from memory when it does on disk
+                self._remember(key, row[0], row[1])
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                return row[0]
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def peek(self, key):
+        # The in-process tier only, without counting it as a lookup
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                return entry[0]
+        return None
+
+    def set(self, key, text):
+        now = time.time()
+        self._remember(key, text, now)
+        if self.path:
+            with self._db() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO translation (key, text, created) VALUES (?, ?, ?)",
+                    (key, text, now),
+                )
+                if now - self._pruned_at > self.prune_interval:
+                    self._pruned_at = now
+                    conn.execute(
+                        "DELETE FROM translation WHERE created <= ?", (now - self.ttl,)
+                    )
+
+    def _remember(self, key, text, now):
+        with self._lock:
+            self._memory[key] = (text, now)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._memory), max_size=self.size)
+
+
+_inflight_lock = threading.Lock()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def init_app(app):
+    app.extensions["translation_cache"] = TranslationCache(
+        app.config["TRANSLATION_CACHE_SIZE"],
+        app.config["TRANSLATION_CACHE_TTL"],
+        app.config["TRANSLATION_CACHE_DB"],
+    )
+    # Made by get_session() when the first translation goes upstream
+    app.extensions["translator_session"] = None
+    # Cache misses currently waiting on the translator, so identical requests share one upstream call
+    app.extensions["translator_calls"] = {}
+
+
+def get_cache():
+    return current_app.extensions["translation_cache"]
+
+
+def get_session():
+    # One keep-alive connection pool for all upstream calls, instead of a new TCP/TLS handshake per call
+    session = current_app.extensions["translator_session"]
+    if session is None:
+        # requests is only imported once a translation actually goes upstream
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=current_app.config["TRANSLATOR_POOL_SIZE"]
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        current_app.extensions["translator_session"] = session
+    return session
+
+
+def cache_key(text, source_language, dest_language):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{digest}:{source_language}:{dest_language}"
 
 
 def translate(text, source_language, dest_language):
-    if "MS_TRANSLATOR_KEY" not in app.config or not app.config["MS_TRANSLATOR_KEY"]:
+    if (
+        "MS_TRANSLATOR_KEY" not in current_app.config
+        or not current_app.config["MS_TRANSLATOR_KEY"]
+    ):
         return _("Error: the translation service is not configured.")
+    cache = get_cache()
+    key = cache_key(text, source_language, dest_language)
+    result = cache.get(key)
+    if result is not None:
+        return result
+    inflight = current_app.extensions["translator_calls"]
+    with _inflight_lock:
+        # A call that finished since the lookup above has cached its result and left inflight
+        result = cache.peek(key)
+        if result is not None:
+            return result
+        call = inflight.get(key)
+        leader = call is None
+        if leader:
+            call = inflight[key] = _Call()
+    if leader:
+        try:
+            translations = _translate_upstream([text], source_language, dest_language)
+            if translations is not None:
+                call.result = translations[0]
+                cache.set(key, call.result)
+        finally:
+            with _inflight_lock:
+                del inflight[key]
+            call.done.set()
+    # The leader's call is bounded by the timeout, this only guards against it never finishing
+    elif not call.done.wait(current_app.config["TRANSLATOR_TIMEOUT"] * 2):
+        return _("Error: the translation service failed.")
+    if call.result is None:
+        return _("Error: the translation service failed.")
+    return call.result
+
+
+def translate_many(items):
+    """Translate a list of (text, source_language, dest_language), batching cache misses upstream.
+
+    Returns a list of translations in the same order, with None for any that failed.
+    """
+    if (
+        "MS_TRANSLATOR_KEY" not in current_app.config
+        or not current_app.config["MS_TRANSLATOR_KEY"]
+    ):
+        return [None] * len(items)
+    cache = get_cache()
+    inflight = current_app.extensions["translator_calls"]
+    results = [None] * len(items)
+    # (source, dest) -> text -> positions in items waiting for that text
+    missing = {}
+    for i, (text, source_language, dest_language) in enumerate(items):
+        result = cache.get(cache_key(text, source_language, dest_language))
+        if result is not None:
+            results[i] = result
+        else:
+            missing.setdefault((source_language, dest_language), {}).setdefault(
+                text, []
+            ).append(i)
+    # Misses another request is already translating are waited for, the rest are registered as
+    # in flight so single translations of the same texts wait for this batch
+    calls = {}
+    waiting = []
+    with _inflight_lock:
+        for (source_language, dest_language), texts in missing.items():
+            for text, positions in list(texts.items()):
+                key = cache_key(text, source_language, dest_language)
+                result = cache.peek(key)
+                if result is not None or key in inflight:
+                    del texts[text]
+                    if result is not None:
+                        for i in positions:
+                            results[i] = result
+                    else:
+                        waiting.append((inflight[key], positions))
+                else:
+                    calls[key] = inflight[key] = _Call()
+    try:
+        # The translator takes an array of texts per language pair, so each pair is one call per chunk
+        size = current_app.config["TRANSLATOR_BATCH_SIZE"]
+        for (source_language, dest_language), texts in missing.items():
+            texts = list(texts.items())
+            for start in range(0, len(texts), size):
+                chunk = texts[start : start + size]
+                translations = _translate_upstream(
+                    [text for text, _positions in chunk], source_language, dest_language
+                )
+                if translations is None:
+                    continue
+                for (text, positions), translation in zip(chunk, translations):
+                    key = cache_key(text, source_language, dest_language)
+                    calls[key].result = translation
+                    cache.set(key, translation)
+                    for i in positions:
+                        results[i] = translation
+    finally:
+        with _inflight_lock:
+            for key in calls:
+                del inflight[key]
+        for call in calls.values():
+            call.done.set()
+    deadline = time.monotonic() + current_app.config["TRANSLATOR_TIMEOUT"] * 2
+    for call, positions in waiting:
+        if call.done.wait(max(0, deadline - time.monotonic())):
+            for i in positions:
+                results[i] = call.result
+    return results
+
+
+def _translate_upstream(texts, source_language, dest_language):
+    # A list of translations in the order of texts, or None if the call failed for any reason
+    import requests
+
     auth = {
-        "Ocp-Apim-Subscription-Key": app.config["MS_TRANSLATOR_KEY"],
+        "Ocp-Apim-Subscription-Key": current_app.config["MS_TRANSLATOR_KEY"],
         "Ocp-Apim-Subscription-Region": "westus",
     }
-    r = requests.post(
-        "https://api.cognitive.microsofttranslator.com"
-        "/translate?api-version=3.0&from={}&to={}".format(
-            source_language, dest_language
-        ),
-        headers=auth,
-        json=[{"Text": text}],
-    )
-    if r.status_code != 200:
-        return _("Error: the translation service failed.")
-    return r.json()[0]["translations"][0]["text"]
+    try:
+        with metrics.timed("translator_seconds"):
+            r = get_session().post(
+                current_app.config["MS_TRANSLATOR_URL"]
+                + "/translate?api-version=3.0&from={}&to={}".format(
+                    source_language, dest_language
+                ),
+                headers=auth,
+                json=[{"Text": text} for text in texts],
+                timeout=current_app.config["TRANSLATOR_TIMEOUT"],
+            )
+        if r.status_code != 200:
+            return None
+        translations = [item["translations"][0]["text"] for item in r.json()]
+    except (requests.RequestException, ValueError, LookupError, TypeError):
+        # Unreachable, too slow, or an answer that isn't the JSON we expect
+        current_app.logger.warning("Translator call failed", exc_info=True)
+        return None
+    if len(translations) != len(texts):
+        return None
+    return translations
@@ -0,0 +1,379 @@
+"""Route-level benchmarks against a seeded database.
+
+    python benchmark.py --users 10000 --posts 1000000 --save-baseline
+    python benchmark.py --users 10000 --posts 1000000 --reuse
+
+Builds (or reuses) a SQLite database with a skewed follow graph, drives the main routes through
+the Flask test client and reports latency percentiles and SQL statements per request, along with
+the memory and suggestion latency of the in-memory follow graph (--follows 100 for ~1M edges), and
+the cold start of a fresh process: importing and creating the app, then serving its first request. With a
+baseline file it exits with status 1 if a route got slower or issues more queries than before.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument(
+        "--follows", type=int, default=50, help="average follows per user"
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=1.1,
+        help="Zipf exponent for who gets followed and who posts",
+    )
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument(
+        "--startups", type=int, default=10, help="fresh processes to time startup in"
+    )
+    parser.add_argument(
+        "--db", default=os.path.join(tempfile.gettempdir(), "microblog-bench.db")
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="don't reseed an existing --db"
+    )
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed p95 slowdown against the baseline",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+args = parse_args()
+# Chosen before config.py is imported, which reads it, and inherited by the startup processes
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+
+import sqlalchemy as sa  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import (  # noqa: E402
+    Post,
+    User,
+    followers,
+    rebuild_timelines,
+    recompute_counters,
+)
+from app import graph  # noqa: E402
+from app import translate as translate_module  # noqa: E402
+
+app = create_app()
+
+CHUNK = 10000
+# Run in a fresh interpreter each time, so nothing is imported or compiled yet
+STARTUP = """
+import json
+import time
+
+start = time.perf_counter()
+from app import create_app
+
+app = create_app()
+created = time.perf_counter()
+# Building the follow graph is measured on its own, not as part of the first request
+app.config.update(WTF_CSRF_ENABLED=False, FOLLOW_SUGGESTIONS=0)
+client = app.test_client()
+with client.session_transaction() as session:
+    session["_user_id"] = "1"
+before = time.perf_counter()
+response = client.get("/explore")
+done = time.perf_counter()
+print(json.dumps({
+    "startup": (created - start) * 1000,
+    "first_request": (done - before) * 1000,
+    "status": response.status_code,
+}))
+"""
+
+
+def zipf_weights(n, skew):
+    # Rank 1 is the most popular account, a few accounts get most of the follows and posts.
+    # Cumulative, so random.choices() doesn't add them all up again on every call
+    return list(itertools.accumulate(1 / (rank**skew) for rank in range(1, n + 1)))
+
+
+def insert_chunked(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            db.session.execute(sa.insert(table), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(sa.insert(table), chunk)
+
+
+def seed(rng):
+    print(f"Seeding {args.users} users, {args.posts} posts into {args.db}")
+    start = time.perf_counter()
+    db.drop_all()
+    db.create_all()
+    # Hashing is slow on purpose, every user shares one (they log in through the session anyway)
+    password_hash = generate_password_hash("password")
+    insert_chunked(
+        User.__table__,
+        (
+            {
+                "id": i,
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "password_hash": password_hash,
+            }
+            for i in range(1, args.users + 1)
+        ),
+    )
+    weights = zipf_weights(args.users, args.skew)
+    ids = list(range(1, args.users + 1))
+
+    def follows():
+        for follower in ids:
+            k = min(args.users - 1, max(1, int(rng.expovariate(1 / args.follows))))
+            for followed in set(rng.choices(ids, cum_weights=weights, k=k)) - {
+                follower
+            }:
+                yield {"follower_id": follower, "followed_id": followed}
+
+    insert_chunked(followers, follows())
+    now = datetime.now(timezone.utc)
+    authors = iter(rng.choices(ids, cum_weights=weights, k=args.posts))
+    insert_chunked(
+        Post.__table__,
+        (
+            {
+                "body": f"post {i}",
+                "user_id": next(authors),
+                "timestamp": now - timedelta(seconds=args.posts - i),
+                "language": rng.choice(["en", "es", "fr"]),
+            }
+            for i in range(args.posts)
+        ),
+    )
+    recompute_counters()
+    rebuild_timelines()
+    db.session.commit()
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+
+class StubTranslator(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps(
+            [{"translations": [{"text": item["Text"].upper()}]} for item in texts]
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def measure_graph(rng):
+    # The routes render suggestions from this copy, built up front rather than in the background
+    follow_graph = graph.FollowGraph(resync=float("inf"))
+    start = time.perf_counter()
+    with app.app_context():
+        follow_graph.build()
+    built = time.perf_counter() - start
+    app.extensions["follow_graph"] = follow_graph
+    info = follow_graph.info()
+    print(
+        f"Follow graph: {info['edges']} edges, {info['bytes'] / 2**20:.1f} MiB "
+        f"({info['bytes_per_edge']:.2f} bytes/edge), built in {built:.1f}s"
+    )
+    latencies = []
+    for _i in range(args.requests):
+        user_id = rng.randint(1, args.users)
+        start = time.perf_counter()
+        follow_graph.suggestions(user_id, 5)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "queries": 0,
+    }
+
+
+def measure_startup():
+    timings = {"startup": [], "first_request": []}
+    for _i in range(args.startups):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        if result["status"] >= 400:
+            raise RuntimeError(f"first request returned {result['status']}")
+        for name in timings:
+            timings[name].append(result[name])
+    return {
+        name: {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "queries": 0,
+        }
+        for name, latencies in timings.items()
+    }
+
+
+def run(rng):
+    statements = []
+    with app.app_context():
+        sa.event.listen(
+            db.engine, "before_cursor_execute", lambda *a: statements.append(a[2])
+        )
+        popular = db.session.scalar(
+            sa.select(User.username).order_by(User.num_followers.desc())
+        )
+        max_post = db.session.scalar(sa.select(sa.func.max(Post.id)))
+    client = app.test_client()
+
+    def login(user_id):
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+
+    def index():
+        login(rng.randint(1, args.users))
+        return client.get("/index")
+
+    def explore():
+        login(rng.randint(1, args.users))
+        return client.get("/explore")
+
+    def user():
+        login(rng.randint(1, args.users))
+        return client.get(f"/user/{popular}")
+
+    def follow():
+        login(rng.randint(1, args.users))
+        return client.post(f"/follow/user{rng.randint(1, args.users)}")
+
+    def translate():
+        login(rng.randint(1, args.users))
+        # Half the texts repeat, so the cache sees both hits and misses
+        text = f"post {rng.randint(1, max_post if rng.random() < 0.5 else 20)}"
+        return client.post(
+            "/translate",
+            json={"text": text, "source_language": "es", "dest_language": "en"},
+        )
+
+    results = {}
+    for name, request in [
+        ("index", index),
+        ("explore", explore),
+        ("user", user),
+        ("follow", follow),
+        ("translate", translate),
+    ]:
+        latencies, counts = [], []
+        for _i in range(args.requests):
+            statements.clear()
+            start = time.perf_counter()
+            response = request()
+            latencies.append((time.perf_counter() - start) * 1000)
+            counts.append(len(statements))
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name} returned {response.status_code}")
+        results[name] = {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "queries": sum(counts) / len(counts),
+        }
+    return results
+
+
+def report(results, baseline):
+    regressions = []
+    print(
+        f"{'route':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}  vs baseline"
+    )
+    for name, r in results.items():
+        line = f"{name:<10} {r['p50']:>9.2f} {r['p95']:>9.2f} {r['p99']:>9.2f} {r['queries']:>8.1f}"
+        old = baseline.get(name)
+        if old:
+            line += f"  p95 {r['p95'] / old['p95'] - 1:+.0%}, queries {r['queries'] - old['queries']:+.1f}"
+            if r["p95"] > old["p95"] * (1 + args.tolerance):
+                regressions.append(
+                    f"{name}: p95 {old['p95']:.2f}ms -> {r['p95']:.2f}ms"
+                )
+            # follow changes the graph it runs on, so allow a little noise in its average
+            if r["queries"] > old["queries"] + 0.5:
+                regressions.append(
+                    f"{name}: {old['queries']:.1f} -> {r['queries']:.1f} queries"
+                )
+        print(line)
+    return regressions
+
+
+def main():
+    rng = random.Random(args.seed)
+    if not (args.reuse and os.path.exists(args.db)):
+        with app.app_context():
+            seed(rng)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubTranslator)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.config.update(
+        WTF_CSRF_ENABLED=False,
+        MS_TRANSLATOR_KEY="benchmark",
+        MS_TRANSLATOR_URL=f"http://127.0.0.1:{server.server_port}",
+    )
+    translate_module.init_app(app)
+    suggestions = measure_graph(rng)
+    results = run(rng)
+    results["suggest"] = suggestions
+    results.update(measure_startup())
+    server.shutdown()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
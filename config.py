@@ -7,6 +7,11 @@ from pathlib import Path
 basedir = Path(__file__).resolve().parent
 
 
+def parse_flag(value):
+    # "0", "false", "no" and "off" turn an on/off setting off, any other value turns it on
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
 class Config:
     SECRET_KEY = os.getenv("SECRET_KEY", "you-will-never-guess")
     # URI is a Uniform Resource Identifier -- it answers "What resource are you talking about"
@@ -14,12 +19,127 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv(
         "DATABASE_URL", f"sqlite:///{basedir / 'app.db'}"
     )
+    # Connection pool settings, only the ones that are set (an in-memory SQLite database has no pool to size)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        name: convert(os.environ[var])
+        for name, var, convert in [
+            ("pool_size", "DB_POOL_SIZE", int),
+            ("max_overflow", "DB_MAX_OVERFLOW", int),
+            ("pool_timeout", "DB_POOL_TIMEOUT", float),
+            ("pool_recycle", "DB_POOL_RECYCLE", int),
+            ("pool_pre_ping", "DB_POOL_PRE_PING", parse_flag),
+        ]
+        if os.getenv(var)
+    }
+    # SQLite tuning applied to every new connection. SQLITE_PERFORMANCE turns on the whole profile,
+    # each SQLITE_* variable overrides one setting and setting it to "" turns that one off
+    # WAL lets readers carry on while last_seen and post commits write, NORMAL syncs only at checkpoints
+    SQLITE_PERFORMANCE = os.getenv("SQLITE_PERFORMANCE") is not None
+    SQLITE_PRAGMAS = {
+        name: value
+        for name, value in {
+            "journal_mode": os.getenv(
+                "SQLITE_JOURNAL_MODE", "WAL" if SQLITE_PERFORMANCE else ""
+            ),
+            "synchronous": os.getenv(
+                "SQLITE_SYNCHRONOUS", "NORMAL" if SQLITE_PERFORMANCE else ""
+            ),
+            "mmap_size": os.getenv(
+                "SQLITE_MMAP_SIZE", str(256 * 1024 * 1024) if SQLITE_PERFORMANCE else ""
+            ),
+            # Negative sizes are in KiB, so 64MB of page cache per connection
+            "cache_size": os.getenv(
+                "SQLITE_CACHE_SIZE", "-64000" if SQLITE_PERFORMANCE else ""
+            ),
+            "busy_timeout": os.getenv(
+                "SQLITE_BUSY_TIMEOUT", "5000" if SQLITE_PERFORMANCE else ""
+            ),
+        }.items()
+        if value
+    }
+    # Read replicas, as a comma separated list of URIs. GET requests read from one of them at random
+    REPLICA_URIS = [
+        uri for uri in os.getenv("REPLICA_DATABASE_URLS", "").split(",") if uri
+    ]
+    SQLALCHEMY_BINDS = {f"replica{i}": uri for i, uri in enumerate(REPLICA_URIS)}
+    REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+    # Seconds a client reads from the primary after a POST, so it sees its own posts and follows
+    REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 10))
     MAIL_SERVER = os.getenv("MAIL_SERVER")
     MAIL_PORT = os.getenv("MAIL_PORT", 25)
     MAIL_USE_TLS = os.getenv("MAIL_USE_TLS") is not None
     MAIL_USERNAME = os.getenv("MAIL_USERNAME")
     MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
     ADMINS = os.getenv("ADMINS")
+    # Outgoing mail is queued and sent by MAIL_WORKERS threads that reuse their SMTP connection
+    MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 100))
+    MAIL_WORKERS = int(os.getenv("MAIL_WORKERS", 2))
+    # When the queue is full, "block" waits up to MAIL_QUEUE_TIMEOUT seconds for room, "drop" gives up at once
+    MAIL_QUEUE_FULL = os.getenv("MAIL_QUEUE_FULL", "block")
+    MAIL_QUEUE_TIMEOUT = float(os.getenv("MAIL_QUEUE_TIMEOUT", 2))
+    # Seconds a worker keeps its SMTP connection open waiting for another message
+    MAIL_IDLE_TIMEOUT = float(os.getenv("MAIL_IDLE_TIMEOUT", 5))
+    # Werkzeug hash method for new passwords, old hashes are upgraded on the next successful login
+    PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+    # Processes that hash passwords off the request threads, 0 hashes inline
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 0))
+    # Hashes allowed in flight per worker process, and seconds to wait for a slot before giving up with a 503
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 8))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 2))
     POSTS_PER_PAGE = 20
+    # Who to follow: suggestions shown in the sidebar (0 hides it), and how often each worker
+    # rebuilds its in-memory copy of the follow graph to pick up follows made by the others
+    FOLLOW_SUGGESTIONS = int(os.getenv("FOLLOW_SUGGESTIONS", 5))
+    FOLLOW_GRAPH_RESYNC = float(os.getenv("FOLLOW_GRAPH_RESYNC", 300))
+    # Most usernames one POST /follow or /unfollow request may (un)follow at once
+    FOLLOW_BATCH_SIZE = int(os.getenv("FOLLOW_BATCH_SIZE", 500))
+    # Server-Sent Events for new posts: open streams per worker, seconds between heartbeats,
+    # and how often each worker looks for posts written by the others
+    STREAM_MAX_CONNECTIONS = int(os.getenv("STREAM_MAX_CONNECTIONS", 100))
+    STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", 15))
+    STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", 1))
+    # Timeline pages carry an ETag and answer 304 when unchanged, for at most this many seconds (0 disables)
+    ETAG_MAX_AGE = int(os.getenv("ETAG_MAX_AGE", 60))
+    # The newest posts are kept in memory for the explore page, reloaded when older than the TTL (seconds)
+    EXPLORE_BUFFER_SIZE = int(os.getenv("EXPLORE_BUFFER_SIZE", 200))
+    EXPLORE_BUFFER_TTL = float(os.getenv("EXPLORE_BUFFER_TTL", 2))
+    # How quickly search results lose rank with age: a post this many days old needs twice the relevance
+    SEARCH_RECENCY_DAYS = float(os.getenv("SEARCH_RECENCY_DAYS", 30))
+    # Collect per-request SQL, template and translator timings and serve them at /metrics
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED") is not None
+    # Scrapers must send "Authorization: Bearer <METRICS_TOKEN>". Without a token /metrics only
+    # answers requests from this machine, which behind a local reverse proxy means everyone
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+    # Requests slower than this are logged with their slowest SQL statements
+    SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 1))
+    # Rendered _post.html fragments kept per worker, 0 renders every post every time
+    POST_FRAGMENT_CACHE_SIZE = int(os.getenv("POST_FRAGMENT_CACHE_SIZE", 1024))
+    # Seconds to keep the logged in user's row in memory instead of loading it on every request, 0 disables.
+    # Each worker has its own copy, a profile edit in one can show old values in the others this long
+    USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 0))
+    # Don't rewrite last_seen if the stored value is younger than this many seconds
+    LAST_SEEN_GRANULARITY = int(os.getenv("LAST_SEEN_GRANULARITY", 0))
+    # Buffer last_seen in memory and write it in batches every LAST_SEEN_FLUSH_INTERVAL seconds
+    LAST_SEEN_BUFFERED = os.getenv("LAST_SEEN_BUFFERED") is not None
+    LAST_SEEN_FLUSH_INTERVAL = int(os.getenv("LAST_SEEN_FLUSH_INTERVAL", 10))
+    # Read the home page from the fan-out-on-write timeline table (run `flask timeline rebuild` after enabling)
+    MATERIALIZED_TIMELINES = os.getenv("MATERIALIZED_TIMELINES") is not None
     LANGUAGES = ["en", "es"]
+    # Detect post languages in a pool of worker processes after the post is saved
+    LANGUAGE_DETECTION_ASYNC = os.getenv("LANGUAGE_DETECTION_ASYNC") is not None
+    LANGUAGE_DETECTION_WORKERS = int(os.getenv("LANGUAGE_DETECTION_WORKERS", 2))
+    LANGDETECT_SEED = int(os.getenv("LANGDETECT_SEED", 0))
     MS_TRANSLATOR_KEY = os.environ.get("MS_TRANSLATOR_KEY")
+    MS_TRANSLATOR_URL = os.getenv(
+        "MS_TRANSLATOR_URL", "https://api.cognitive.microsofttranslator.com"
+    )
+    # Keep-alive connections kept open to the translator, and texts sent per upstream call
+    TRANSLATOR_POOL_SIZE = int(os.getenv("TRANSLATOR_POOL_SIZE", 10))
+    TRANSLATOR_BATCH_SIZE = int(os.getenv("TRANSLATOR_BATCH_SIZE", 100))
+    # Seconds to wait for the translator to connect and to answer, before giving up on the call
+    TRANSLATOR_TIMEOUT = float(os.getenv("TRANSLATOR_TIMEOUT", 10))
+    # In-process LRU of translations: number of entries and seconds each one is kept
+    TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", 4096))
+    TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", 24 * 60 * 60))
+    # SQLite file shared by all workers that keeps translations across restarts, unset to disable
+    TRANSLATION_CACHE_DB = os.getenv("TRANSLATION_CACHE_DB")
@@ -0,0 +1,36 @@
+"""post search index
+
+Revision ID: d3f19a6e4b85
+Revises: b7d24e9c0a13
+Create Date: 2026-10-17 14:02:41.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f19a6e4b85'
+down_revision = 'b7d24e9c0a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 is SQLite only, other databases search with a scan. Existing posts are indexed
+    # afterwards with `flask search rebuild`, so the upgrade itself stays quick
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5(body, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+    op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END")
+    op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); END")
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER post_fts_update')
+    op.execute('DROP TRIGGER post_fts_delete')
+    op.execute('DROP TRIGGER post_fts_insert')
+    op.execute('DROP TABLE post_fts')
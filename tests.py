@@ -1,11 +1,47 @@
 import os
-
-os.environ["DATABASE_URL"] = "sqlite://"
-
 from datetime import datetime, timezone, timedelta
+import importlib
+import json
+import smtplib
+import socketserver
+import subprocess
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
 import unittest
-from app import app, db
-from app.models import User, Post
+from contextlib import contextmanager
+from unittest import mock
+from flask import g
+import sqlalchemy as sa
+from app import create_app, db
+from app import bulk
+from app import models
+from app import passwords
+from app import recent
+from app import search
+from app import stream
+from app.models import User, Post, rebuild_timelines, recompute_counters
+from app.pagination import paginate_keyset
+from app.sqlite import apply_pragmas
+from app import email as email_module
+from app import fragments
+from app import graph
+from app import language
+from app import last_seen
+from app import translate as translate_module
+from app.translate import TranslationCache, translate
+import config
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+
+
+app = create_app(TestConfig)
 
 
 class UserModelCase(unittest.TestCase):
@@ -25,6 +61,45 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password("dog"))
         self.assertTrue(u.check_password("cat"))
 
+    def test_password_rehash(self):
+        app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+        self.addCleanup(app.config.update, PASSWORD_HASH_METHOD="scrypt")
+        u = User(username="susan", email="susan@example.com")
+        u.set_password("cat")
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:2000"
+        self.assertFalse(u.check_password("dog"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        # a successful check upgrades the hash to the configured cost
+        self.assertTrue(u.check_password("cat"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:2000$"))
+        self.assertTrue(u.check_password("cat"))
+
+    def test_password_hashing_pool(self):
+        app.config.update(
+            PASSWORD_HASH_WORKERS=1,
+            PASSWORD_HASH_MAX_PENDING=1,
+            PASSWORD_HASH_TIMEOUT=0,
+        )
+        self.addCleanup(
+            app.config.update,
+            PASSWORD_HASH_WORKERS=0,
+            PASSWORD_HASH_MAX_PENDING=8,
+            PASSWORD_HASH_TIMEOUT=2,
+        )
+        self.addCleanup(passwords.init_app, app)
+        u = User(username="susan", email="susan@example.com")
+        u.set_password("cat")
+        self.assertTrue(u.check_password("cat"))
+        self.assertFalse(u.check_password("dog"))
+        # with every slot taken, new work is turned away instead of queueing up
+        executor, slots = passwords._get_pool()
+        self.addCleanup(executor.shutdown)
+        slots.acquire()
+        self.addCleanup(slots.release)
+        with self.assertRaises(passwords.HashingBusy):
+            u.check_password("cat")
+
     def test_avatar(self):
         u = User(username="john", email="john@example.com")
         self.assertEqual(
@@ -35,6 +110,12 @@ class UserModelCase(unittest.TestCase):
                 "?d=identicon&s=128"
             ),
         )
+        # the digest is stored, and follows changes to the email
+        self.assertEqual(u.email_hash, "d4c74594d841139328695756648b6bd6")
+        u.email = "John@Example.com"
+        self.assertEqual(u.email_hash, "d4c74594d841139328695756648b6bd6")
+        u.email = "susan@example.com"
+        self.assertNotEqual(u.email_hash, "d4c74594d841139328695756648b6bd6")
 
     def test_follow(self):
         u1 = User(username="john", email="john@example.com")
@@ -63,6 +144,44 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        u3 = User(username="mary", email="mary@example.com")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        self.assertEqual((u1.num_followers, u1.num_following, u1.num_posts), (0, 0, 0))
+
+        u1.follow(u2)
+        u1.follow(u3)
+        u1.follow(u3)  # already following, no change
+        u2.add_post("post from susan")
+        db.session.commit()
+        self.assertEqual(u1.num_following, 2)
+        self.assertEqual(u3.num_followers, 1)
+        self.assertEqual(u2.num_posts, 1)
+
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.num_following, u1.following_count())
+        self.assertEqual(u3.num_followers, u3.followers_count())
+        self.assertEqual(recompute_counters(), [])
+
+        # posts added behind the model's back are found and fixed
+        db.session.add(Post(body="post from mary", author=u3))
+        db.session.commit()
+        self.assertEqual(recompute_counters(), [("mary", "num_posts", 0, 1)])
+        db.session.commit()
+        self.assertEqual(u3.num_posts, 1)
+
+        # a user that isn't in the database yet counts its first post too
+        u4 = User(username="david", email="david@example.com")
+        db.session.add(u4)
+        u4.add_post("post from david")
+        db.session.commit()
+        self.assertEqual(u4.num_posts, 1)
+        self.assertEqual(recompute_counters(), [])
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username="john", email="john@example.com")
@@ -105,6 +224,1155 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_posts(self):
+        app.config["MATERIALIZED_TIMELINES"] = True
+        self.addCleanup(app.config.update, MATERIALIZED_TIMELINES=False)
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        u3 = User(username="mary", email="mary@example.com")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # posts written before the follow are backfilled
+        p1 = u2.add_post("post from susan")
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        # posts written after the follow are fanned out
+        p2 = u3.add_post("post from mary")
+        p3 = u1.add_post("post from john")
+        db.session.commit()
+
+        # the join in following_posts() is the reference answer
+        for u in [u1, u2, u3]:
+            self.assertEqual(
+                set(db.session.scalars(u.timeline_posts()).all()),
+                set(db.session.scalars(u.following_posts()).all()),
+            )
+        self.assertEqual(
+            set(db.session.scalars(u1.timeline_posts()).all()), {p1, p2, p3}
+        )
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(set(db.session.scalars(u1.timeline_posts()).all()), {p2, p3})
+
+        # posts added without fan out are picked up by a rebuild
+        db.session.add(Post(body="post from susan again", author=u2))
+        db.session.commit()
+        rebuild_timelines()
+        db.session.commit()
+        for u in [u1, u2, u3]:
+            self.assertEqual(
+                db.session.scalars(u.timeline_posts()).all(),
+                db.session.scalars(u.following_posts()).all(),
+            )
+
+    def test_keyset_pagination(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        # two posts share a timestamp to check the id tie-breaker
+        now = datetime.now(timezone.utc)
+        posts = [
+            Post(body=f"post {i}", author=u, timestamp=now + timedelta(seconds=i // 2))
+            for i in range(5)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+        query = u.posts.select().order_by(Post.timestamp.desc())
+
+        page1 = paginate_keyset(query, per_page=2)
+        self.assertEqual(page1.items, newest_first[0:2])
+        self.assertFalse(page1.has_prev)
+        self.assertTrue(page1.has_next)
+        page2 = paginate_keyset(query, per_page=2, before=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[2:4])
+        self.assertTrue(page2.has_prev)
+        page3 = paginate_keyset(query, per_page=2, before=page2.next_cursor)
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertFalse(page3.has_next)
+
+        # walking back towards newer posts returns the same pages
+        back = paginate_keyset(query, per_page=2, after=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        back = paginate_keyset(query, per_page=2, after=back.prev_cursor)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        # a garbled cursor falls back to the first page
+        self.assertEqual(
+            paginate_keyset(query, per_page=2, before="junk").items, page1.items
+        )
+
+    def test_last_seen_buffering(self):
+        app.config.update(LAST_SEEN_BUFFERED=True, LAST_SEEN_GRANULARITY=60)
+        self.addCleanup(
+            app.config.update, LAST_SEEN_BUFFERED=False, LAST_SEEN_GRANULARITY=0
+        )
+        stale = datetime.now(timezone.utc) - timedelta(hours=1)
+        u1 = User(username="john", email="john@example.com", last_seen=stale)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        fresh = u2.last_seen
+
+        last_seen.record(u1)
+        last_seen.record(u2)  # seen within the granularity, nothing to write
+        # nothing is written until the buffer is flushed
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, stale.replace(tzinfo=None))
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertGreater(u1.last_seen, stale.replace(tzinfo=None))
+        self.assertEqual(u2.last_seen, fresh)
+
+    def test_language_detection_later(self):
+        u = User(username="juan", email="juan@example.com")
+        db.session.add(u)
+        post = u.add_post("Hola, ¿cómo estás? Hoy hace muy buen tiempo en Madrid.")
+        db.session.commit()
+        self.assertIsNone(post.language)
+        self.assertEqual(
+            language.detect_later(post.id, post.body).result(timeout=30), "es"
+        )
+        db.session.expire_all()
+        self.assertEqual(post.language, "es")
+        # langdetect answers this one differently from call to call unless the workers are seeded
+        executor = language._get_executor()
+        self.addCleanup(language.init_app, app)
+        self.addCleanup(executor.shutdown)
+        detected = [
+            executor.submit(language._detect, "hello bonjour hola ciao")
+            for _ in range(50)
+        ]
+        self.assertEqual(len({future.result(timeout=30) for future in detected}), 1)
+
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = sa.create_engine(f"sqlite:///{tmpdir}/app.db")
+            apply_pragmas(
+                engine,
+                {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000},
+            )
+            with engine.connect() as conn:
+                values = [
+                    conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                    for name in ["journal_mode", "synchronous", "busy_timeout"]
+                ]
+            # synchronous reads back as a number, 1 is NORMAL
+            self.assertEqual(values, ["wal", 1, 5000])
+            engine.dispose()
+
+    def test_data_export_import(self):
+        u1 = User(username="john", email="john@example.com", about_me="")
+        u2 = User(username="susan", email="susan@example.com")
+        u3 = User(username="mary", email="mary@example.com")
+        u4 = User(username="david", email="david@example.com")
+        db.session.add_all([u1, u2, u3, u4])
+        # "" is a language detection couldn't tell, None one it hasn't run for yet
+        u1.add_post("post from john", language="")
+        u2.add_post("post from susan")
+        u1.follow(u2)
+        db.session.commit()
+        users = [
+            {"id": user.id, "username": user.username, "email": user.email}
+            for user in (u1, u2, u3, u4)
+        ]
+        runner = app.test_cli_runner()
+
+        for format in ["jsonl", "csv"]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                r = runner.invoke(args=["data", "export", tmpdir, "--format", format])
+                self.assertIn("users: 4 rows", r.output)
+                db.session.remove()
+                db.drop_all()
+                db.create_all()
+
+                # an import in chunks of two that checkpointed the first two users, then
+                # committed the next two, resumed in smaller chunks
+                for user in users:
+                    db.session.execute(sa.insert(User), [user])
+                db.session.commit()
+                bulk.save_checkpoint(tmpdir, {"users": 2, "chunk_size": 2})
+
+                r = runner.invoke(
+                    args=[
+                        "data",
+                        "import",
+                        tmpdir,
+                        "--format",
+                        format,
+                        "--chunk-size",
+                        "1",
+                    ]
+                )
+                self.assertEqual(r.exit_code, 0, r.output)
+                self.assertIn("users: resuming after 2 rows", r.output)
+                self.assertFalse(os.path.exists(os.path.join(tmpdir, bulk.CHECKPOINT)))
+                john = db.session.scalar(sa.select(User).where(User.username == "john"))
+                susan = db.session.scalar(
+                    sa.select(User).where(User.username == "susan")
+                )
+                self.assertTrue(john.is_following(susan))
+                self.assertEqual((john.num_following, susan.num_followers), (1, 1))
+                self.assertEqual(
+                    [p.body for p in db.session.scalars(john.following_posts())],
+                    ["post from susan", "post from john"],
+                )
+                self.assertEqual(
+                    [p.language for p in db.session.scalars(john.following_posts())],
+                    [None, ""],
+                )
+
+
+class RoutesCase(unittest.TestCase):
+    def setUp(self):
+        app.config["WTF_CSRF_ENABLED"] = False
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        # Each test starts with an empty database, so with an empty explore buffer too
+        recent.init_app(app)
+        # Built here, so rendering the sidebar doesn't start a build in the background
+        app.extensions["follow_graph"] = graph.FollowGraph(resync=3600)
+        graph.get_graph().build()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        app.config["WTF_CSRF_ENABLED"] = True
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+
+    def forget_request_state(self):
+        # Requests share the test's app context, so the session and the user Flask-Login
+        # keeps on g would otherwise carry over from one request to the next
+        db.session.expunge_all()
+        g.pop("_login_user", None)
+
+    @contextmanager
+    def assert_max_queries(self, n):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            sa.event.remove(db.engine, "before_cursor_execute", count)
+        self.assertLessEqual(len(statements), n, "\n\n".join(statements))
+
+    def test_timeline_query_count(self):
+        # render every post so the fragment cache can't hide lazy loads
+        app.extensions["post_fragments"] = fragments.FragmentCache(0)
+        self.addCleanup(fragments.init_app, app)
+        viewer = User(username="viewer", email="viewer@example.com")
+        db.session.add(viewer)
+        for i in range(20):
+            author = User(username=f"author{i}", email=f"author{i}@example.com")
+            db.session.add(author)
+            author.add_post(f"post {i}")
+            db.session.flush()
+            viewer.follow(author)
+        db.session.commit()
+        self.login(viewer)
+
+        for url in ["/explore", "/index"]:
+            # user, last seen, posts, authors
+            with self.assert_max_queries(5):
+                r = self.client.get(url)
+            self.assertEqual(r.data.count(b"said"), 20)
+
+    def test_cached_load_user(self):
+        app.config.update(USER_CACHE_TTL=60, LAST_SEEN_GRANULARITY=60)
+        self.addCleanup(app.config.update, USER_CACHE_TTL=0, LAST_SEEN_GRANULARITY=0)
+        self.addCleanup(app.extensions["user_cache"].clear)
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+
+        self.client.get("/edit_profile")
+        self.forget_request_state()
+        with self.assert_max_queries(0):
+            r = self.client.get("/edit_profile")
+        self.assertIn(b"john", r.data)
+
+        # a profile change drops the snapshot, the next request sees the new name
+        self.client.post("/edit_profile", data={"username": "johnny", "about_me": ""})
+        self.forget_request_state()
+        with self.assert_max_queries(1) as statements:
+            r = self.client.get("/edit_profile")
+        self.assertIn(b"johnny", r.data)
+        self.assertIn("FROM user", statements[0])
+
+        # a password changed in another worker isn't stale here, the hash is never cached
+        self.assertNotIn("password_hash", app.extensions["user_cache"][u.id][1])
+        db.session.execute(
+            sa.update(User).where(User.id == u.id).values(password_hash="new hash")
+        )
+        db.session.commit()
+        self.forget_request_state()
+        self.assertEqual(models.load_user(str(u.id)).password_hash, "new hash")
+
+    def test_replica_routing(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        replica = sa.create_engine(f"sqlite:///{tmpdir.name}/replica.db")
+        self.addCleanup(replica.dispose)
+        db.engines["replica0"] = replica
+        app.config["REPLICA_BINDS"] = ["replica0"]
+        self.addCleanup(db.engines.pop, "replica0")
+        self.addCleanup(app.config.update, REPLICA_BINDS=[])
+        app.extensions["post_fragments"] = fragments.FragmentCache(0)
+        self.addCleanup(fragments.init_app, app)
+
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        u.add_post("post on the primary")
+        db.session.commit()
+        # a replica that has the user but is lagging behind on posts
+        db.metadata.create_all(replica)
+        with replica.begin() as conn:
+            conn.execute(
+                sa.insert(User.__table__),
+                [{"id": u.id, "username": "john", "email": "x"}],
+            )
+            conn.execute(
+                sa.insert(Post.__table__),
+                [
+                    {
+                        "id": 99,
+                        "body": "post on the replica",
+                        "user_id": u.id,
+                        "timestamp": datetime.now(timezone.utc),
+                    }
+                ],
+            )
+        self.login(u)
+
+        self.forget_request_state()
+        r = self.client.get("/explore")
+        self.assertIn(b"post on the replica", r.data)
+        self.assertNotIn(b"post on the primary", r.data)
+
+        # after writing, this client reads from the primary for a while
+        self.client.post("/index", data={"post": "another post"})
+        self.forget_request_state()
+        r = self.client.get("/explore")
+        self.assertIn(b"another post", r.data)
+        self.assertIn(b"post on the primary", r.data)
+
+    def test_post_fragment_cache(self):
+        app.extensions["post_fragments"] = fragments.FragmentCache(100)
+        self.addCleanup(fragments.init_app, app)
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        u.add_post("post from john")
+        db.session.commit()
+        self.login(u)
+
+        self.client.get("/user/john")
+        self.client.get("/explore")
+        info = fragments.get_cache().info()
+        self.assertEqual((info["hits"], info["misses"]), (1, 1))
+
+        # renaming the author must not serve the old name
+        self.client.post("/edit_profile", data={"username": "johnny", "about_me": ""})
+        self.assertEqual(fragments.get_cache().info()["size"], 0)
+        r = self.client.get("/explore")
+        self.assertIn(b"johnny", r.data)
+
+    def test_explore_buffer(self):
+        app.extensions["recent_posts"] = recent.RecentPosts(4, ttl=60)
+        app.config["POSTS_PER_PAGE"] = 2
+        self.addCleanup(app.config.update, POSTS_PER_PAGE=20)
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        for i in range(6):
+            db.session.add(
+                Post(body=f"post {i}", author=u, timestamp=now - timedelta(minutes=i))
+            )
+        db.session.commit()
+        self.login(u)
+
+        self.client.get("/explore")
+        with self.assert_max_queries(10) as statements:
+            r = self.client.get("/explore")
+        self.assertFalse([s for s in statements if "FROM post" in s])
+        self.assertIn(b"post 0", r.data)
+        self.assertIn(b"post 1", r.data)
+
+        # the buffer ends after the next page, so it comes from the database
+        cursor = recent.get_buffer().page(2).next_cursor
+        with self.assert_max_queries(10) as statements:
+            r = self.client.get(f"/explore?before={cursor}")
+        self.assertTrue([s for s in statements if "FROM post" in s])
+        self.assertIn(b"post 2", r.data)
+        self.assertIn(b"post 3", r.data)
+
+        # new posts go straight into the buffer
+        self.client.post("/index", data={"post": "a new post"})
+        posts = recent.get_buffer().page(2)
+        self.assertEqual([p.body for p in posts.items], ["a new post", "post 0"])
+        # post 3 fell off the end, so the buffer can't tell if there is a page after post 2
+        self.assertIsNone(recent.get_buffer().page(2, before=posts.next_cursor))
+
+    def test_timeline_etags(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        u2.add_post("post from susan")
+        db.session.commit()
+        self.login(u1)
+
+        r = self.client.get("/index")
+        etag = r.headers["ETag"]
+        self.forget_request_state()
+        with self.assert_max_queries(3) as statements:
+            r = self.client.get("/index", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertFalse([s for s in statements if "post.body" in s])
+
+        # following someone changes the home page even though no post is newer
+        self.client.post("/follow/susan")
+        self.forget_request_state()
+        r = self.client.get("/index", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b"post from susan", r.data)
+        # the page showed the "You are following" flash
+        self.assertNotIn("ETag", r.headers)
+        self.forget_request_state()
+        etag = self.client.get("/index").headers["ETag"]
+
+        self.client.post("/index", data={"post": "post from john"})
+        self.client.get("/index")  # shows the flash
+        self.forget_request_state()
+        r = self.client.get("/index", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+
+        # the JSON variant is validated the same way, and pages in JSON too
+        r = self.client.get("/user/susan?format=json")
+        self.assertEqual(
+            [p["body"] for p in r.get_json()["posts"]], ["post from susan"]
+        )
+        self.assertIsNone(r.get_json()["next_url"])
+        self.forget_request_state()
+        r = self.client.get(
+            "/user/susan?format=json", headers={"If-None-Match": r.headers["ETag"]}
+        )
+        self.assertEqual(r.status_code, 304)
+        r = self.client.get("/explore?format=json")
+        self.assertEqual(
+            [p["author"]["username"] for p in r.get_json()["posts"]],
+            ["john", "susan"],
+        )
+
+    def test_post_events(self):
+        # deliveries are run by hand here instead of by the poller thread
+        streams = stream.get_streams()
+        self.enterContext(mock.patch.object(streams, "poller", object()))
+        app.config.update(STREAM_MAX_CONNECTIONS=1, STREAM_HEARTBEAT=0.01)
+        self.addCleanup(
+            app.config.update, STREAM_MAX_CONNECTIONS=100, STREAM_HEARTBEAT=15
+        )
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        u3 = User(username="mary", email="mary@example.com")
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        missed = u2.add_post("missed post")
+        db.session.commit()
+        self.login(u1)
+
+        r = self.client.get("/events", headers={"Last-Event-ID": str(missed.id - 1)})
+        self.assertEqual(r.mimetype, "text/event-stream")
+        events = iter(r.response)
+        self.assertEqual(
+            next(events),
+            f'id: {missed.id}\nevent: post\ndata: {{"id": {missed.id}, "author": "susan"}}\n\n'.encode(),
+        )
+        # the server keeps iterating the stream after the view returned, with no app context
+        heartbeat = []
+        thread = threading.Thread(target=lambda: heartbeat.append(next(events)))
+        thread.start()
+        thread.join()
+        self.assertEqual(heartbeat, [b": heartbeat\n\n"])
+        # one stream per worker in this test
+        self.forget_request_state()
+        self.assertEqual(self.client.get("/events").status_code, 503)
+
+        post = u2.add_post("new post")
+        u3.add_post("not followed")
+        db.session.commit()
+        self.assertEqual(stream._deliver(streams, missed.id), post.id + 1)
+        self.assertIn(f"id: {post.id}\n".encode(), next(events))
+        self.assertEqual(next(events), b": heartbeat\n\n")
+        r.close()
+        self.assertEqual(len(streams.subscribers), 0)
+
+    def test_poller_errors(self):
+        app.config["STREAM_POLL_INTERVAL"] = 0.01
+        self.addCleanup(app.config.update, STREAM_POLL_INTERVAL=1)
+        delivered = []
+
+        class Stop(BaseException):
+            # not an Exception, so it gets past the poller's error handling and ends it
+            pass
+
+        def deliver(streams, last_id):
+            delivered.append(last_id)
+            raise Stop()
+
+        def poll():
+            try:
+                stream._poll(app, stream.Streams())
+            except Stop:
+                pass
+
+        failure = sa.exc.OperationalError("SELECT", {}, Exception("database is locked"))
+        with (
+            mock.patch.object(db.session, "scalar", side_effect=[failure, 7]),
+            mock.patch.object(stream, "_deliver", deliver),
+            self.assertLogs(app.logger, "ERROR"),
+        ):
+            poller = threading.Thread(target=poll)
+            poller.start()
+            poller.join(5)
+        self.assertEqual(delivered, [7])
+
+    def test_follow_suggestions(self):
+        john, susan, mary, david = [
+            User(username=name, email=f"{name}@example.com")
+            for name in ["john", "susan", "mary", "david"]
+        ]
+        db.session.add_all([john, susan, mary, david])
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        susan.follow(mary)
+        db.session.commit()
+        graph.get_graph().build()
+        self.assertEqual(graph.get_graph().info()["edges"], 5)
+        # mary is already followed, david is followed by two of the people john follows
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [(david.id, 2)])
+        ids = [user.id for user in (john, susan, mary, david)]
+
+        self.login(john)
+        r = self.client.get("/index")
+        self.assertIn(b"Followed by 2 people you follow", r.data)
+        # follows made here apply at once, without a rebuild
+        self.client.post("/follow/david")
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [])
+        self.client.post("/unfollow/mary")
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [(mary.id, 1)])
+
+        # and so do follows made through the model anywhere else, once they commit
+        self.forget_request_state()
+        john, susan, mary, david = [db.session.get(User, id) for id in ids]
+        david.follow(mary)
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [(mary.id, 1)])
+        db.session.commit()
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [(mary.id, 2)])
+        john.unfollow(david)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(graph.get_graph().suggestions(john.id, 5), [(mary.id, 2)])
+
+    def test_bulk_follow(self):
+        app.config["MATERIALIZED_TIMELINES"] = True
+        self.addCleanup(app.config.update, MATERIALIZED_TIMELINES=False)
+        john, susan, mary, david = [
+            User(username=name, email=f"{name}@example.com")
+            for name in ["john", "susan", "mary", "david"]
+        ]
+        db.session.add_all([john, susan, mary, david])
+        john.follow(susan)
+        mary.add_post("post from mary")
+        db.session.commit()
+        self.login(john)
+        ids = [user.id for user in [john, susan, mary]]
+        self.forget_request_state()
+
+        def reload():
+            db.session.expunge_all()
+            return [db.session.get(User, id) for id in ids]
+
+        usernames = ["susan", "mary", "david", "john", "nobody"]
+        with self.assert_max_queries(10) as statements:
+            r = self.client.post("/follow", json={"usernames": usernames})
+        self.assertEqual(
+            r.get_json()["results"],
+            {
+                "susan": "already following",
+                "mary": "followed",
+                "david": "followed",
+                "john": "self",
+                "nobody": "not found",
+            },
+        )
+        # one statement for all the follows, no SELECT per user first
+        self.assertEqual(
+            len([s for s in statements if s.startswith("INSERT INTO followers")]), 1
+        )
+        john, susan, mary = reload()
+        # only the follows that were inserted are counted
+        self.assertEqual(john.num_following, 3)
+        self.assertEqual(john.follow_version, 2)
+        self.assertEqual([susan.num_followers, mary.num_followers], [1, 1])
+        self.assertEqual(
+            [p.body for p in db.session.scalars(john.timeline_posts())],
+            ["post from mary"],
+        )
+        self.assertEqual(graph.get_graph().suggestions(mary.id, 5), [])
+        self.forget_request_state()
+
+        # following again changes nothing, so nothing invalidates the pages
+        r = self.client.post("/follow", json={"usernames": ["mary"]})
+        self.assertEqual(r.get_json()["results"], {"mary": "already following"})
+        r = self.client.post("/follow/mary")
+        john, susan, mary = reload()
+        self.assertEqual(john.follow_version, 2)
+        self.assertEqual(mary.num_followers, 1)
+        self.forget_request_state()
+
+        r = self.client.post("/unfollow", json={"usernames": ["mary", "susan", "mary"]})
+        self.assertEqual(
+            r.get_json()["results"], {"mary": "unfollowed", "susan": "unfollowed"}
+        )
+        r = self.client.post("/unfollow", json={"usernames": ["mary"]})
+        self.assertEqual(r.get_json()["results"], {"mary": "not following"})
+        john, susan, mary = reload()
+        self.assertEqual(john.num_following, 1)
+        self.assertEqual([susan.num_followers, mary.num_followers], [0, 0])
+        self.assertEqual(list(db.session.scalars(john.timeline_posts())), [])
+
+        self.forget_request_state()
+        r = self.client.post("/follow", json={"usernames": ["x"] * 501})
+        self.assertEqual(r.status_code, 400)
+        for body in ({}, {"usernames": "susan"}, {"usernames": [1, 2]}, ["susan"]):
+            r = self.client.post("/follow", json=body)
+            self.assertEqual(r.status_code, 400)
+
+    def test_search(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        for i, body in enumerate(
+            ["el café está frío", "hot coffee", "coffee and cake", "cake"]
+        ):
+            db.session.add(Post(body=body, author=u, timestamp=now - timedelta(days=i)))
+        db.session.commit()
+        self.login(u)
+
+        # diacritics are folded, "cafe" finds "café"
+        r = self.client.get("/search?q=cafe")
+        self.assertIn("el café está frío", r.get_data(as_text=True))
+        page = search.search_posts("coffee", per_page=1)
+        self.assertEqual([p.body for p in page.items], ["hot coffee"])
+        page = search.search_posts("coffee", per_page=1, cursor=page.next_cursor)
+        self.assertEqual([p.body for p in page.items], ["coffee and cake"])
+        self.assertIsNone(page.next_cursor)
+        # query syntax is searched for as words, not parsed
+        self.assertEqual(
+            [p.body for p in search.search_posts('"cake AND', per_page=5).items],
+            ["coffee and cake"],
+        )
+
+        # the triggers keep the index in step, and a rebuild puts back the same rows
+        db.session.delete(db.session.scalar(sa.select(Post).where(Post.body == "cake")))
+        db.session.commit()
+        self.assertEqual(
+            [p.body for p in search.search_posts("cake", per_page=5).items],
+            ["coffee and cake"],
+        )
+        self.assertEqual(search.rebuild_index(batch_size=2), 3)
+        self.assertEqual(len(search.search_posts("coffee", per_page=5).items), 2)
+
+    def test_metrics(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        app.config["METRICS_ENABLED"] = True
+        self.addCleanup(app.config.update, METRICS_ENABLED=False)
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+
+        with self.assert_max_queries(10) as statements:
+            self.client.get("/explore")
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 200)
+        text = r.get_data(as_text=True)
+        self.assertIn(
+            f'microblog_request_sql_statements_sum{{endpoint="main.explore"}} '
+            f"{len(statements)}",
+            text,
+        )
+        self.assertIn(
+            'microblog_request_seconds_count{endpoint="main.explore"} 1', text
+        )
+        self.assertIn("microblog_email_queue_depth 0", text)
+
+        # without a token only local requests are answered, with one only scrapers that send it
+        remote = {"REMOTE_ADDR": "203.0.113.7"}
+        self.assertEqual(
+            self.client.get("/metrics", environ_base=remote).status_code, 403
+        )
+        app.config["METRICS_TOKEN"] = "secret"
+        self.addCleanup(app.config.update, METRICS_TOKEN=None)
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        r = self.client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(r.status_code, 401)
+        r = self.client.get(
+            "/metrics", environ_base=remote, headers={"Authorization": "Bearer secret"}
+        )
+        self.assertEqual(r.status_code, 200)
+
+
+class TranslationCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app.config.update(
+            MS_TRANSLATOR_KEY="key",
+            TRANSLATION_CACHE_DB=os.path.join(self.tmpdir.name, "cache.db"),
+        )
+        translate_module.init_app(app)
+        self.calls = []
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        app.config.update(MS_TRANSLATOR_KEY=None, TRANSLATION_CACHE_DB=None)
+        translate_module.init_app(app)
+        self.tmpdir.cleanup()
+
+    def fake_upstream(self, texts, source_language, dest_language):
+        self.calls.extend(texts)
+        time.sleep(0.1)
+        return [f"{text} ({dest_language})" for text in texts]
+
+    def test_cache_tiers(self):
+        with mock.patch.object(
+            translate_module, "_translate_upstream", self.fake_upstream
+        ):
+            self.assertEqual(translate("hola", "es", "en"), "hola (en)")
+            self.assertEqual(translate("hola", "es", "en"), "hola (en)")
+            self.assertEqual(translate("hola", "es", "fr"), "hola (fr)")
+            # a new process only has the SQLite tier
+            translate_module.init_app(app)
+            self.assertEqual(translate("hola", "es", "en"), "hola (en)")
+        self.assertEqual(self.calls, ["hola", "hola"])
+        self.assertEqual(translate_module.get_cache().info()["disk_hits"], 1)
+
+    def test_disk_expiry(self):
+        path = os.path.join(self.tmpdir.name, "expiry.db")
+        cache = TranslationCache(size=10, ttl=60, path=path)
+        cache.set("old", "1")
+        cache.set("new", "2")
+        # stored two minutes ago, as another worker's cache would find it
+        with cache._db() as conn:
+            conn.execute(
+                "UPDATE translation SET created = ? WHERE key = 'old'",
+                (time.time() - 120,),
+            )
+        cache = TranslationCache(size=10, ttl=60, path=path)
+        self.assertIsNone(cache.get("old"))
+        self.assertEqual(cache.get("new"), "2")
+        # the next write clears expired rows out of the file
+        cache.set("newer", "3")
+        keys = [row[0] for row in cache._db().execute("SELECT key FROM translation")]
+        self.assertEqual(sorted(keys), ["new", "newer"])
+
+    def test_lru_eviction(self):
+        cache = TranslationCache(size=2, ttl=60)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.info()["evictions"], 1)
+
+    def test_coalesced_misses(self):
+        results = []
+
+        def request_translation():
+            with app.app_context():
+                results.append(translate("hola", "es", "en"))
+
+        with mock.patch.object(
+            translate_module, "_translate_upstream", self.fake_upstream
+        ):
+            threads = [threading.Thread(target=request_translation) for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(results, ["hola (en)"] * 5)
+        self.assertEqual(self.calls, ["hola"])
+
+        # a call that finished between a request's cache miss and it joining the calls in flight
+        cache = translate_module.get_cache()
+        cache.set(translate_module.cache_key("adios", "es", "en"), "bye")
+        with (
+            mock.patch.object(
+                translate_module, "_translate_upstream", self.fake_upstream
+            ),
+            mock.patch.object(cache, "get", return_value=None),
+        ):
+            self.assertEqual(translate("adios", "es", "en"), "bye")
+        self.assertEqual(self.calls, ["hola"])
+
+    def test_coalesced_batch_misses(self):
+        results = []
+
+        def in_background(fn, *args):
+            def run():
+                with app.test_request_context():
+                    results.append(fn(*args))
+
+            thread = threading.Thread(target=run)
+            thread.start()
+            # until its call is in flight
+            for _i in range(1000):
+                if app.extensions["translator_calls"]:
+                    break
+                time.sleep(0.001)
+            return thread
+
+        with mock.patch.object(
+            translate_module, "_translate_upstream", self.fake_upstream
+        ):
+            # a batch waits for a text being translated already, and sends only the rest
+            thread = in_background(translate, "hola", "es", "en")
+            batch = translate_module.translate_many(
+                [("hola", "es", "en"), ("adios", "es", "en")]
+            )
+            thread.join()
+            # and a single translation waits for a batch sending its text
+            thread = in_background(
+                translate_module.translate_many, [("uno", "es", "en")]
+            )
+            single = translate("uno", "es", "en")
+            thread.join()
+        self.assertEqual(batch, ["hola (en)", "adios (en)"])
+        self.assertEqual(single, "uno (en)")
+        self.assertEqual(results, ["hola (en)", ["uno (en)"]])
+        self.assertEqual(self.calls, ["hola", "adios", "uno"])
+
+
+class StubTranslator(BaseHTTPRequestHandler):
+    # Speaks just enough of the translator API: upper-cases every text it is sent
+    protocol_version = "HTTP/1.1"
+    requests_seen = []
+    connections_seen = set()
+    # Set by tests to make it answer slowly, or with something that isn't JSON
+    delay = 0
+    broken = False
+
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests_seen.append(self.path)
+        self.connections_seen.add(self.client_address)
+        time.sleep(self.delay)
+        body = json.dumps(
+            [{"translations": [{"text": item["Text"].upper()}]} for item in texts]
+        ).encode("utf-8")
+        if self.broken:
+            body = b"<html>Service Unavailable</html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BatchTranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubTranslator)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubTranslator.requests_seen.clear()
+        StubTranslator.connections_seen.clear()
+        app.config.update(
+            MS_TRANSLATOR_KEY="key",
+            MS_TRANSLATOR_URL=f"http://127.0.0.1:{self.server.server_port}",
+        )
+        translate_module.init_app(app)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+        app.config.update(MS_TRANSLATOR_KEY=None, TRANSLATOR_TIMEOUT=10)
+        StubTranslator.delay = 0
+        StubTranslator.broken = False
+        translate_module.init_app(app)
+
+    def test_batch_endpoint(self):
+        u = User(username="juan", email="juan@example.com")
+        posts = [Post(body=f"hola {i}", author=u, language="es") for i in range(3)]
+        posts.append(Post(body="bonjour", author=u, language="fr"))
+        db.session.add_all(posts)
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u.id)
+
+        items = [
+            {"post_id": p.id, "source_language": p.language, "dest_language": "en"}
+            for p in posts
+        ]
+        items.append({"post_id": 12345, "source_language": "es", "dest_language": "en"})
+        r = client.post("/translate/batch", json={"items": items})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            r.get_json()["translations"],
+            {str(p.id): p.body.upper() for p in posts},
+        )
+        # one upstream call per language pair, over a single kept-alive connection
+        self.assertEqual(len(StubTranslator.requests_seen), 2)
+        self.assertEqual(len(StubTranslator.connections_seen), 1)
+
+        # everything is cached now, including for the single-text endpoint
+        client.post("/translate/batch", json={"items": items})
+        r = client.post(
+            "/translate",
+            json={"text": "hola 0", "source_language": "es", "dest_language": "en"},
+        )
+        self.assertEqual(r.get_json()["text"], "HOLA 0")
+        self.assertEqual(len(StubTranslator.requests_seen), 2)
+
+        # malformed requests are turned away before anything is looked up
+        for body in (
+            None,
+            [],
+            {},
+            {"items": "hola"},
+            {"items": [{"post_id": posts[0].id}]},
+            {"items": [{"post_id": "1", "dest_language": "en"}]},
+            {"items": [{"post_id": 1, "dest_language": "en", "source_language": 5}]},
+        ):
+            r = client.post("/translate/batch", json=body)
+            self.assertEqual(r.status_code, 400)
+        self.assertEqual(len(StubTranslator.requests_seen), 2)
+
+    def test_upstream_failures(self):
+        items = [("hola", "es", "en")]
+        StubTranslator.broken = True
+        self.assertEqual(translate_module.translate_many(items), [None])
+        StubTranslator.broken = False
+        app.config["TRANSLATOR_TIMEOUT"] = 0.2
+        StubTranslator.delay = 1
+        started = time.time()
+        self.assertEqual(translate_module.translate_many(items), [None])
+        self.assertLess(time.time() - started, 1)
+        with app.test_request_context():
+            self.assertEqual(
+                translate_module.translate("hola", "es", "en"),
+                "Error: the translation service failed.",
+            )
+        # nothing was cached, it is translated once the translator recovers
+        StubTranslator.delay = 0
+        self.assertEqual(translate_module.translate_many(items), ["HOLA"])
+
+
+class StubSMTP(socketserver.StreamRequestHandler):
+    # A debugging SMTP server that just keeps the DATA of every message it is sent
+    messages = []
+    connections = 0
+
+    def handle(self):
+        StubSMTP.connections += 1
+        self.wfile.write(b"220 stub\r\n")
+        while line := self.rfile.readline():
+            command = line[:4].upper()
+            if command == b"DATA":
+                self.wfile.write(b"354 go ahead\r\n")
+                data = b""
+                while (line := self.rfile.readline()) != b".\r\n":
+                    data += line
+                self.messages.append(data)
+                self.wfile.write(b"250 ok\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 ok\r\n")
+
+
+class EmailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StubSMTP)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubSMTP.messages.clear()
+        StubSMTP.connections = 0
+        state = app.extensions["mail"]
+        patcher = mock.patch.multiple(
+            state,
+            server="127.0.0.1",
+            port=self.server.server_address[1],
+            suppress=False,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        email_module.init_app(app)
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+        email_module.init_app(app)
+        app.config.update(
+            MAIL_WORKERS=2,
+            MAIL_QUEUE_SIZE=100,
+            MAIL_QUEUE_FULL="block",
+            MAIL_IDLE_TIMEOUT=5,
+        )
+
+    def send(self, n):
+        return [
+            email_module.send_email(
+                f"message {i}",
+                "admin@example.com",
+                ["susan@example.com"],
+                "hi",
+                "<p>hi</p>",
+            )
+            for i in range(n)
+        ]
+
+    def test_connection_reuse(self):
+        app.config.update(MAIL_WORKERS=1, MAIL_IDLE_TIMEOUT=0.2)
+        before = email_module.stats()
+        self.send(5)
+        app.extensions["mail_queue"].join()
+        self.assertEqual(len(StubSMTP.messages), 5)
+        # one worker sends the whole burst over a single connection
+        self.assertEqual(StubSMTP.connections, 1)
+        after = email_module.stats()
+        self.assertEqual(after["sent"] - before["sent"], 5)
+        self.assertEqual(after["queued"], 0)
+
+    def test_send_failures(self):
+        app.config.update(MAIL_WORKERS=1, MAIL_IDLE_TIMEOUT=0.2)
+        send = email_module._send
+        # subject -> how many more times sending it fails
+        failing = {"message 0": 1, "message 1": 2}
+
+        def flaky_send(conn, msg):
+            if failing.get(msg.subject):
+                failing[msg.subject] -= 1
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            send(conn, msg)
+
+        before = email_module.stats()
+        with (
+            mock.patch.object(email_module, "_send", flaky_send),
+            self.assertLogs(app.logger, "WARNING") as logs,
+        ):
+            self.send(3)
+            app.extensions["mail_queue"].join()
+        # message 0 went through on a second connection, message 1 failed on both
+        subjects = [
+            m.split(b"Subject: ")[1].split(b"\r\n")[0] for m in StubSMTP.messages
+        ]
+        self.assertEqual(subjects, [b"message 0", b"message 2"])
+        after = email_module.stats()
+        self.assertEqual(after["sent"] - before["sent"], 2)
+        self.assertEqual(after["failed"] - before["failed"], 1)
+        self.assertIn("Dropped email 'message 1' to susan@example.com", logs.output[-1])
+
+    def test_drop_when_full(self):
+        app.config.update(MAIL_WORKERS=0, MAIL_QUEUE_SIZE=2, MAIL_QUEUE_FULL="drop")
+        before = email_module.stats()["dropped"]
+        self.assertEqual(self.send(3), [True, True, False])
+        self.assertEqual(email_module.stats()["dropped"] - before, 1)
+        self.assertEqual(email_module.stats()["queued"], 2)
+
+
+class ConfigCase(unittest.TestCase):
+    def load(self, **environ):
+        # Config reads the environment when the module is imported
+        with mock.patch.dict(os.environ):
+            for var in [var for var in os.environ if var.startswith("DB_POOL_")]:
+                del os.environ[var]
+            os.environ.update(environ)
+            try:
+                return importlib.reload(config).Config
+            finally:
+                importlib.reload(config)
+
+    def test_engine_options(self):
+        self.assertEqual(self.load().SQLALCHEMY_ENGINE_OPTIONS, {})
+        self.assertEqual(
+            self.load(
+                DB_POOL_SIZE="20", DB_POOL_TIMEOUT="2.5", DB_POOL_PRE_PING="1"
+            ).SQLALCHEMY_ENGINE_OPTIONS,
+            {"pool_size": 20, "pool_timeout": 2.5, "pool_pre_ping": True},
+        )
+        for value in ("0", "false", "No", "off"):
+            self.assertEqual(
+                self.load(DB_POOL_PRE_PING=value).SQLALCHEMY_ENGINE_OPTIONS,
+                {"pool_pre_ping": False},
+            )
+        self.assertEqual(self.load(DB_POOL_PRE_PING="").SQLALCHEMY_ENGINE_OPTIONS, {})
+
+    def test_per_app_state(self):
+        # caches, pools, queues and the threads that serve them belong to one app each
+        other = create_app(TestConfig)
+        for name in (
+            "event_streams",
+            "last_seen",
+            "translator_calls",
+            "follow_graph",
+            "user_cache",
+        ):
+            self.assertIsNot(other.extensions[name], app.extensions[name])
+
+
+class StartupCase(unittest.TestCase):
+    def test_lazy_imports(self):
+        # A fresh interpreter, this one has imported everything by now
+        script = (
+            "import sys\n"
+            "from app import create_app\n"
+            "create_app()\n"
+            "print(' '.join(sorted(m for m in sys.modules if '.' not in m)))\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "DATABASE_URL": "sqlite://"},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        modules = set(output.split())
+        self.assertIn("flask_sqlalchemy", modules)
+        for heavy in ["alembic", "flask_migrate", "jwt", "langdetect", "requests"]:
+            self.assertNotIn(heavy, modules)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)